@@ -0,0 +1,46 @@
+"""
+Time to import kglib modules in a fresh interpreter.
+
+Also lists heavy dependencies imported as a side effect,
+which should be none since they are loaded on first use.
+
+Usage: python benchmarks/import_time.py [module ...]
+"""
+import subprocess
+import sys
+
+
+HEAVY_MODULES = ['dateutil', 'nltk', 'numpy', 'pandas', 'scipy', 'sklearn', 'xgboost']
+
+SCRIPT = '''
+import sys
+import time
+start_time = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start_time
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print('{{:.3f}} {{}}'.format(elapsed, ','.join(heavy) or '-'))
+'''
+
+
+def measure(module, n_repeats=5):
+    """Return the best import time out of several runs and heavy modules imported."""
+    timings = []
+    heavy = None
+    for _ in range(n_repeats):
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT.format(module=module, heavy=HEAVY_MODULES)])
+        elapsed, heavy = output.decode().split()
+        timings.append(float(elapsed))
+    return min(timings), heavy
+
+
+def main():
+    modules = sys.argv[1:] or ['kglib.runner', 'kglib.conf', 'kglib.models']
+    for module in modules:
+        elapsed, heavy = measure(module)
+        print('{:<24} {:8.3f} s  heavy: {}'.format(module, elapsed, heavy))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Peak memory of FillNanPreprocessor and JoinFeatureExtractor.
+
+Peak is measured with tracemalloc relative to the size of the inputs.
+
+Usage: python benchmarks/join_fill_memory.py [n_rows] [n_inputs]
+"""
+import sys
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from kglib.feature_extractors import JoinFeatureExtractor
+from kglib.preprocessors import FillNanPreprocessor
+
+
+def make_dataframes(n_rows, n_inputs, n_cols=5, seed=0):
+    rng = np.random.RandomState(seed)
+    dataframes = []
+    for i in range(n_inputs):
+        values = rng.rand(n_rows, n_cols)
+        values[values < 0.1] = np.nan
+        columns = ['f{}_{}'.format(i, j) for j in range(n_cols)]
+        dataframes.append(pd.DataFrame(values, columns=columns))
+    return dataframes
+
+
+def measure(name, func, input_bytes):
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    print('{:<12} peak {:8.1f} MB ({:.2f}x inputs)'.format(
+        name, peak / 2 ** 20, peak / input_bytes))
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    n_inputs = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    dataframes = make_dataframes(n_rows, n_inputs)
+    input_bytes = sum(df.memory_usage(index=True).sum() for df in dataframes)
+    names = ['input{}'.format(i) for i in range(n_inputs)]
+
+    fill_nan = FillNanPreprocessor('input0', 'filled0',
+                                   columns=list(dataframes[0].columns), fill_value=0)
+    join = JoinFeatureExtractor(names, 'joined')
+
+    print('{} rows, {} inputs, {:.1f} MB'.format(n_rows, n_inputs, input_bytes / 2 ** 20))
+    measure('fill nan', lambda: fill_nan.process(dataframes[:1]),
+            dataframes[0].memory_usage(index=True).sum())
+    measure('join', lambda: join.process(dataframes), input_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Throughput of StringReplacementPreprocessor on synthetic text columns.
+
+Usage: python benchmarks/string_replacement.py [n_rows]
+"""
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from kglib.preprocessors import StringReplacementPreprocessor
+
+
+WORDS = ['steel', 'in.', 'ft.', 'lbs.', 'x', 'white', 'deck', 'screws', 'gal.', 'door']
+
+SUBSTITUTIONS = [
+    ('in.', 'inch'),
+    ('ft.', 'foot'),
+    ('lbs.', 'pound'),
+    ('gal.', 'gallon'),
+    (r'(\d+)x(\d+)', r'\1 x \2'),
+]
+
+LITERAL_SUBSTITUTIONS = [(re.escape(p), r) for p, r in SUBSTITUTIONS[:4]] + SUBSTITUTIONS[4:]
+
+
+def make_dataframe(n_rows, words_per_row=8, seed=0):
+    rng = np.random.RandomState(seed)
+    tokens = rng.choice(WORDS, size=(n_rows, words_per_row))
+    text = pd.Series([' '.join(row) for row in tokens])
+    return pd.DataFrame({'text': text})
+
+
+def apply_baseline(dataframe, substitutions):
+    """Per-cell re.sub as implemented before vectorization."""
+    data = dataframe['text']
+    for pattern, repl in substitutions:
+        data = data.apply(lambda x, p=pattern, r=repl: re.sub(p, r, x))
+    return data
+
+
+def measure(name, func, n_rows):
+    start_time = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start_time
+    print('{:<24} {:8.2f} s {:12.0f} rows/s'.format(name, elapsed, n_rows / elapsed))
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    dataframe = make_dataframe(n_rows)
+
+    def vectorized(fuse_literals):
+        processor = StringReplacementPreprocessor(
+            'text', 'text_out', columns=['text'],
+            substitutions=LITERAL_SUBSTITUTIONS, fuse_literals=fuse_literals)
+        return lambda: processor.process([dataframe])
+
+    print('{} rows'.format(n_rows))
+    measure('baseline apply', lambda: apply_baseline(dataframe, LITERAL_SUBSTITUTIONS), n_rows)
+    measure('vectorized', vectorized(False), n_rows)
+    measure('vectorized, fused', vectorized(True), n_rows)
+
+
+if __name__ == '__main__':
+    main()
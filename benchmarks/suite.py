@@ -0,0 +1,380 @@
+"""
+Timing and peak memory of kglib hot paths on synthetic data.
+
+Every benchmark runs at each requested scale. Time is the best of several runs.
+Peak memory is measured in a separate run traced with tracemalloc, which sees
+numpy and pandas buffers but not memory allocated by native libraries (e.g. xgboost).
+Setup such as data generation isn't measured. Benchmarks that fail
+(e.g. because of a missing optional dependency) are recorded with the error.
+
+Results are saved as JSON, so runs on different commits can be compared:
+
+    python benchmarks/suite.py -o before.json
+    python benchmarks/suite.py -o after.json --compare before.json
+
+Usage: python benchmarks/suite.py [-s SCALE,...] [-b BENCHMARK,...] [-r N] [-o PATH] [--compare PATH]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from kglib.conf import BaseConfig
+from kglib.cross_val import CrossValidator, get_fold_positions
+from kglib.datasets import (NumpyMemmapDataset, PandasCsvDataset, PandasFeatherDataset,
+                            PandasParquetDataset)
+from kglib.feature_extractors import JoinFeatureExtractor
+from kglib.model_maker import ModelMaker
+from kglib.models import FeatureMatrix, XgbModel
+from kglib.preprocessors import (ExtractColumnPreprocessor, FillNanPreprocessor,
+                                 StemmerPreprocessor, StringReplacementPreprocessor)
+from kglib.profiling import get_peak_rss
+from kglib.runner import Runner
+from kglib.submission import SubmissionMaker
+
+
+SCALES = {
+    'small': 10000,
+    'medium': 100000,
+    'large': 1000000,
+}
+
+N_FEATURES = 20
+
+WORDS = ['steel', 'white', 'deck', 'screws', 'door', 'paint', 'wood', 'light',
+         'outdoor', 'glass', 'in.', 'ft.', 'lbs.', 'gal.', '2x4', 'hinges', 'running', 'doors']
+
+SUBSTITUTIONS = [
+    (r'in\.', 'inch'),
+    (r'ft\.', 'foot'),
+    (r'lbs\.', 'pound'),
+    (r'gal\.', 'gallon'),
+    (r'(\d+)x(\d+)', r'\1 x \2'),
+]
+
+XGB_PARAMS = {
+    'num_boost_round': 20,
+    'max_depth': 6,
+    'nthread': 1,
+}
+
+
+def make_numeric(n_rows, n_cols=N_FEATURES, seed=0, target=True):
+    """A dataframe of float features with missing values and a relevance target."""
+    rng = np.random.RandomState(seed)
+    values = rng.rand(n_rows, n_cols)
+    columns = ['f{}'.format(i) for i in range(n_cols)]
+    dataframe = pd.DataFrame(values, columns=columns)
+    if target:
+        dataframe['relevance'] = 1 + 2 * values[:, 0] * values[:, 1] + 0.1 * rng.rand(n_rows)
+    # Missing values are added after the target depends on the features.
+    dataframe[columns] = dataframe[columns].mask(rng.rand(n_rows, n_cols) < 0.1)
+    return dataframe
+
+
+def make_text(n_rows, words_per_row=8, seed=0):
+    """A dataframe of short product-title-like texts."""
+    rng = np.random.RandomState(seed)
+    tokens = rng.choice(WORDS, size=(n_rows, words_per_row))
+    return pd.DataFrame({'text': [' '.join(row) for row in tokens]})
+
+
+def rmse(y_true, y_pred):
+    return float(np.sqrt(np.mean((y_true - y_pred) ** 2)))
+
+
+# Benchmarks: functions of (n_rows, work_dir) doing the setup
+# and returning a function to measure.
+
+def bench_dataset_save(dataset_type):
+    def setup(n_rows, work_dir):
+        dataframe = make_numeric(n_rows)
+        params = dataset_type.params_from_dataframe(dataframe)
+        path = os.path.join(work_dir, 'dataset')
+
+        def run():
+            dataset_type(path, dataframe=dataframe, **params).save()
+        return run
+    return setup
+
+
+def bench_dataset_load(dataset_type):
+    def setup(n_rows, work_dir):
+        dataframe = make_numeric(n_rows)
+        params = dataset_type.params_from_dataframe(dataframe)
+        path = os.path.join(work_dir, 'dataset')
+        dataset_type(path, dataframe=dataframe, **params).save()
+
+        def run():
+            # Memory-mapped datasets are paged in when read, so read every value.
+            return dataset_type(path, **params).dataframe.values.sum()
+        return run
+    return setup
+
+
+def bench_extract_column(n_rows, work_dir):
+    dataframes = [make_numeric(n_rows)]
+    preprocessor = ExtractColumnPreprocessor('input', 'output', col_name='f0')
+    return lambda: preprocessor.process(dataframes)
+
+
+def bench_fill_nan(n_rows, work_dir):
+    dataframes = [make_numeric(n_rows)]
+    columns = ['f{}'.format(i) for i in range(N_FEATURES)]
+    preprocessor = FillNanPreprocessor('input', 'output', columns=columns, fill_value=0)
+    return lambda: preprocessor.process(dataframes)
+
+
+def bench_string_replacement(n_rows, work_dir):
+    dataframes = [make_text(n_rows)]
+    preprocessor = StringReplacementPreprocessor('input', 'output', columns=['text'],
+                                                 substitutions=SUBSTITUTIONS, fuse_literals=True)
+    return lambda: preprocessor.process(dataframes)
+
+
+def bench_stemmer(n_rows, work_dir):
+    dataframes = [make_text(n_rows)]
+    preprocessor = StemmerPreprocessor('input', 'output', columns=['text'])
+    return lambda: preprocessor.process(dataframes)
+
+
+def bench_join(n_rows, work_dir, n_inputs=4):
+    dataframes = [make_numeric(n_rows, n_cols=5, seed=i, target=False).add_prefix('i{}_'.format(i))
+                  for i in range(n_inputs)]
+    names = ['input{}'.format(i) for i in range(n_inputs)]
+    extractor = JoinFeatureExtractor(names, 'output')
+    return lambda: extractor.process(dataframes)
+
+
+def bench_gen_folds(n_rows, work_dir):
+    dataframe = make_numeric(n_rows)
+    cross_validator = CrossValidator(None, 'train', 'relevance', rmse)
+    return lambda: cross_validator._gen_folds(dataframe, 3, 5)  # pylint: disable=protected-access
+
+
+def bench_fold_slicing(n_rows, work_dir):
+    dataframe = make_numeric(n_rows)
+    cross_validator = CrossValidator(None, 'train', 'relevance', rmse)
+    folds = cross_validator._gen_folds(dataframe, 3, 5)  # pylint: disable=protected-access
+
+    def run():
+        matrix = FeatureMatrix(dataframe, 'relevance')
+        for assignment in folds:
+            for fold_idx in range(5):
+                train_pos, test_pos = get_fold_positions(assignment, fold_idx)
+                matrix.take(train_pos)
+                matrix.take(test_pos)
+    return run
+
+
+def bench_xgb_fit(n_rows, work_dir):
+    matrix = FeatureMatrix(make_numeric(n_rows), 'relevance')
+    return lambda: XgbModel(**XGB_PARAMS).fit_matrix(matrix)
+
+
+def bench_xgb_predict(n_rows, work_dir):
+    matrix = FeatureMatrix(make_numeric(n_rows), 'relevance')
+    model = XgbModel(**XGB_PARAMS)
+    model.fit_matrix(matrix)
+    test_dataframe = make_numeric(n_rows, seed=1, target=False)
+    return lambda: model.predict(test_dataframe)
+
+
+class BenchmarkConfig(BaseConfig):
+    """A project of a preprocessor, cross-validation, a model and a submission."""
+
+    def __init__(self, root_dir, assets_dir):
+        self._root_dir = root_dir
+        super().__init__(assets_dir=assets_dir)
+
+        self.sources = {
+            'train': PandasCsvDataset(os.path.join(self.data_dir, 'train.csv'),
+                                      to_csv_params={'index': False}),
+            'test': PandasCsvDataset(os.path.join(self.data_dir, 'test.csv'),
+                                     to_csv_params={'index': False}),
+        }
+
+        columns = ['f{}'.format(i) for i in range(N_FEATURES)]
+        self.actions = [
+            FillNanPreprocessor(['train', 'test'], ['train_filled', 'test_filled'],
+                                columns=columns, fill_value=0),
+            CrossValidator(XgbModel(**XGB_PARAMS), 'train_filled', 'relevance', rmse),
+            ModelMaker('xgb', XgbModel(**XGB_PARAMS), 'train_filled', 'relevance', rmse),
+            SubmissionMaker('submission.csv', 'xgb', 'test_filled'),
+        ]
+
+    def _get_root_dir(self):
+        return self._root_dir
+
+    def configure_logging(self):
+        # Keep benchmark output readable.
+        pass
+
+
+def bench_runner(n_rows, work_dir):
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir)
+    make_numeric(n_rows).to_csv(os.path.join(data_dir, 'train.csv'), index=False)
+    make_numeric(n_rows, seed=1, target=False).to_csv(os.path.join(data_dir, 'test.csv'),
+                                                      index=False)
+
+    def run():
+        # A fresh assets directory per run, so nothing is cached.
+        assets_dir = tempfile.mkdtemp(prefix='assets', dir=work_dir)
+        try:
+            Runner(BenchmarkConfig(work_dir, assets_dir)).run()
+        finally:
+            shutil.rmtree(assets_dir)
+    return run
+
+
+BENCHMARKS = [
+    ('save_csv', bench_dataset_save(PandasCsvDataset)),
+    ('load_csv', bench_dataset_load(PandasCsvDataset)),
+    ('save_parquet', bench_dataset_save(PandasParquetDataset)),
+    ('load_parquet', bench_dataset_load(PandasParquetDataset)),
+    ('save_feather', bench_dataset_save(PandasFeatherDataset)),
+    ('load_feather', bench_dataset_load(PandasFeatherDataset)),
+    ('save_npy', bench_dataset_save(NumpyMemmapDataset)),
+    ('load_npy', bench_dataset_load(NumpyMemmapDataset)),
+    ('extract_column', bench_extract_column),
+    ('fill_nan', bench_fill_nan),
+    ('string_replacement', bench_string_replacement),
+    ('stemmer', bench_stemmer),
+    ('join', bench_join),
+    ('gen_folds', bench_gen_folds),
+    ('fold_slicing', bench_fold_slicing),
+    ('xgb_fit', bench_xgb_fit),
+    ('xgb_predict', bench_xgb_predict),
+    ('runner', bench_runner),
+]
+
+
+def measure(run, n_repeats):
+    """Return the best time of n_repeats runs and the peak traced memory of one more run."""
+    timings = []
+    for _ in range(n_repeats):
+        start_time = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start_time)
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return min(timings), peak
+
+
+def run_benchmark(name, setup, scale, n_repeats):
+    n_rows = SCALES[scale]
+    result = {'benchmark': name, 'scale': scale, 'n_rows': n_rows}
+
+    work_dir = tempfile.mkdtemp(prefix='kglib-bench')
+    try:
+        run = setup(n_rows, work_dir)
+        result['time'], result['peak_memory'] = measure(run, n_repeats)
+    except Exception as exc:  # pylint: disable=broad-except
+        result['error'] = '{}: {}'.format(exc.__class__.__name__, exc)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return result
+
+
+def get_commit():
+    try:
+        output = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.decode().strip()
+
+
+def format_result(result, previous=None):
+    line = '{:<20} {:<8}'.format(result['benchmark'], result['scale'])
+    if 'error' in result:
+        return line + ' error: ' + result['error']
+
+    line += ' {:9.3f} s {:9.1f} MB'.format(result['time'], result['peak_memory'] / 2 ** 20)
+    if previous is not None and 'error' not in previous:
+        line += '   time {:5.2f}x  memory {:5.2f}x'.format(
+            result['time'] / previous['time'],
+            result['peak_memory'] / max(previous['peak_memory'], 1))
+    return line
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-s', '--scales', default='small,medium',
+                        help='comma-separated scales out of {}'.format(', '.join(SCALES)))
+    parser.add_argument('-b', '--benchmarks', default=None,
+                        help='comma-separated benchmark names, all by default')
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='number of timed runs per benchmark')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='path to save results to')
+    parser.add_argument('--compare', default=None, metavar='PATH',
+                        help='results of an earlier run to compare with')
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    scales = args.scales.split(',')
+    unknown = [scale for scale in scales if scale not in SCALES]
+    if unknown:
+        parser.error('unknown scales: {}'.format(', '.join(unknown)))
+
+    benchmarks = BENCHMARKS
+    if args.benchmarks is not None:
+        names = args.benchmarks.split(',')
+        known = dict(BENCHMARKS)
+        unknown = [name for name in names if name not in known]
+        if unknown:
+            parser.error('unknown benchmarks: {}'.format(', '.join(unknown)))
+        benchmarks = [(name, known[name]) for name in names]
+
+    previous = {}
+    if args.compare is not None:
+        with open(args.compare) as src:
+            for result in json.load(src)['results']:
+                previous[result['benchmark'], result['scale']] = result
+
+    results = []
+    for scale in scales:
+        for name, setup in benchmarks:
+            result = run_benchmark(name, setup, scale, args.repeats)
+            results.append(result)
+            print(format_result(result, previous.get((name, scale))))
+            sys.stdout.flush()
+
+    report = {
+        'commit': get_commit(),
+        'created_at': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'process_peak_rss': get_peak_rss(),
+        'results': results,
+    }
+    with open(args.output, 'w') as dst:
+        json.dump(report, dst, indent=2)
+
+
+if __name__ == '__main__':
+    main()
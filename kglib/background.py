@@ -0,0 +1,108 @@
+import concurrent.futures
+import threading
+
+
+class Prefetcher:
+    """
+    Load dataframes on a background thread ahead of their use.
+
+    Loaded dataframes are kept until taken or discarded.
+    """
+
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='kglib-prefetch')
+        # (name, columns) -> (dataset, future)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_key(name, columns):
+        return name, tuple(columns) if columns is not None else None
+
+    def submit(self, name, dataset, columns=None):
+        """Start loading columns of a dataset unless it's already being loaded."""
+        key = self._get_key(name, columns)
+        with self._lock:
+            if key in self._futures and self._futures[key][0] is dataset:
+                return
+            future = self._executor.submit(dataset.get_dataframe, columns)
+            self._futures[key] = (dataset, future)
+
+    def take(self, name, dataset, columns=None):
+        """
+        Return a prefetched dataframe waiting for it to load if needed.
+
+        Returns None if the dataframe wasn't prefetched.
+        """
+        key = self._get_key(name, columns)
+        with self._lock:
+            entry = self._futures.pop(key, None)
+        if entry is None or entry[0] is not dataset:
+            return None
+        return entry[1].result()
+
+    def discard(self, name):
+        """Forget dataframes prefetched for a dataset waiting for loads in progress."""
+        with self._lock:
+            keys = [key for key in self._futures if key[0] == name]
+            entries = [self._futures.pop(key) for key in keys]
+
+        for dataset, future in entries:
+            if not future.cancel():
+                # A running load caches the dataframe in the dataset, drop it once finished.
+                concurrent.futures.wait([future])
+                dataset.release()
+
+    def shutdown(self):
+        with self._lock:
+            for _, future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self._executor.shutdown(wait=True)
+
+
+class SaveQueue:
+    """
+    Save datasets on a background thread in submission order.
+
+    Saved datasets keep their dataframes in memory, so they can be used
+    while being written. Wait for a dataset before releasing it.
+    """
+
+    def __init__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='kglib-save')
+        # name -> futures of pending saves
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, names, save):
+        """Call save() on the background thread. It saves datasets with the given names."""
+        future = self._executor.submit(save)
+        with self._lock:
+            for name in names:
+                self._futures.setdefault(name, []).append(future)
+
+    def wait(self, name):
+        """Wait until pending saves of a dataset are finished. Raises their errors."""
+        with self._lock:
+            futures = self._futures.pop(name, [])
+        for future in futures:
+            future.result()
+
+    def wait_all(self):
+        """Wait for all pending saves. Raises the first error after all of them are finished."""
+        with self._lock:
+            # A save of several datasets is listed under each of them.
+            futures = list(dict.fromkeys(future for name_futures in self._futures.values()
+                                         for future in name_futures))
+            self._futures.clear()
+
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        try:
+            self.wait_all()
+        finally:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,85 @@
+"""
+Command-line interface.
+
+Example:
+    kglib run myproject.config.Config --target submission1 --dry-run
+"""
+import argparse
+import os
+import sys
+
+from . import utils
+from .runner import Runner, UnknownTargetError
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='kglib')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='run a project pipeline')
+    run_parser.add_argument('config', help='path to a config class, e.g. project.config.Config')
+    run_parser.add_argument('--path', default=os.getcwd(), metavar='DIR',
+                            help='directory to import the config from (default: current directory)')
+    run_parser.add_argument('-t', '--target', action='append', dest='targets', metavar='NAME',
+                            help='run only this action and its dependencies (repeatable)')
+    run_parser.add_argument('-f', '--force', action='append', default=[], metavar='DATASET',
+                            help='recompute this dataset even if cached (repeatable)')
+    run_parser.add_argument('-n', '--dry-run', action='store_true',
+                            help='show which actions would run or use cache and exit')
+    run_parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='number of actions run concurrently')
+    run_parser.add_argument('--chunk-size', type=int, default=None,
+                            help='stream row-local preprocessors in chunks of this many rows')
+    run_parser.add_argument('--prefetch', type=int, default=1, metavar='N',
+                            help='load inputs of the next N actions in the background (0 disables)')
+    run_parser.add_argument('--async-save', action='store_true',
+                            help='save outputs used by later actions in the background; '
+                                 'processors must not modify their inputs in place')
+
+    return parser
+
+
+def import_config(parser, args):
+    """Import the config class or exit with a parser error."""
+    # Console scripts don't have the current directory on sys.path.
+    path = os.path.abspath(args.path)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+    if '.' not in args.config:
+        parser.error('config must be a dotted path to a class, e.g. project.config.Config')
+    try:
+        return utils.import_class_by_path(args.config)
+    except (ImportError, AttributeError) as exc:
+        parser.error('can\'t import config {}: {}'.format(args.config, exc))
+
+
+def run(args, config_cls):
+    config = config_cls()
+
+    runner = Runner(config, n_jobs=args.jobs, chunk_size=args.chunk_size, force=args.force,
+                    prefetch=args.prefetch, async_save=args.async_save)
+
+    if args.dry_run:
+        for action, cached in runner.plan(args.targets):
+            print('{:<6} {}'.format('cached' if cached else 'run', action))
+        return
+
+    runner.run(args.targets)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'run':
+            run(args, import_config(parser, args))
+    except UnknownTargetError as exc:
+        # Errors of the pipeline itself propagate with their tracebacks.
+        parser.exit(2, 'kglib: error: {}\n'.format(exc))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,7 @@
 import inspect
 import logging.config
 import os
+import threading
 
 from .meta import Meta, CVMeta, FeaturesMeta, ModelMeta, PreprocessorMeta
 from .utils import ensure_dir_exists
@@ -21,25 +22,15 @@ class BaseConfig:
         self.assets_dir = os.path.join(self.root_dir, assets_dir)
         ensure_dir_exists(self.assets_dir)
 
-        preprocessed_dir = os.path.join(self.assets_dir, 'preprocessed')
-        ensure_dir_exists(preprocessed_dir)
-        self.preprocessed_meta = PreprocessorMeta(os.path.join(preprocessed_dir, 'meta.json'))
-
-        features_dir = os.path.join(self.assets_dir, 'features')
-        ensure_dir_exists(features_dir)
-        self.features_meta = FeaturesMeta(os.path.join(features_dir, 'meta.json'))
-
-        cv_dir = os.path.join(self.assets_dir, 'cv')
-        ensure_dir_exists(cv_dir)
-        self.cv_meta = CVMeta(os.path.join(cv_dir, 'meta.json'))
-
-        model_dir = os.path.join(self.assets_dir, 'models')
-        ensure_dir_exists(model_dir)
-        self.model_meta = ModelMeta(os.path.join(model_dir, 'meta.json'))
-
-        submission_dir = os.path.join(self.assets_dir, 'submissions')
-        ensure_dir_exists(submission_dir)
-        self.submission_meta = Meta(os.path.join(submission_dir, 'meta.json'))
+        # Metas are loaded on first access, see __getattr__.
+        self._metas_lock = threading.Lock()
+        self._meta_specs = {
+            'preprocessed_meta': (PreprocessorMeta, 'preprocessed'),
+            'features_meta': (FeaturesMeta, 'features'),
+            'cv_meta': (CVMeta, 'cv'),
+            'model_meta': (ModelMeta, 'models'),
+            'submission_meta': (Meta, 'submissions'),
+        }
 
         self._logging_config = {
             'version': 1,
@@ -69,6 +60,22 @@ class BaseConfig:
             },
         }
 
+    def __getattr__(self, name):
+        # Metas are created on first access and then stored as regular attributes,
+        # so subclasses can still assign their own.
+        meta_specs = self.__dict__.get('_meta_specs', {})
+        if name not in meta_specs:
+            raise AttributeError(name)
+
+        with self._metas_lock:
+            if name not in self.__dict__:
+                meta_cls, dirname = meta_specs[name]
+                meta_dir = os.path.join(self.assets_dir, dirname)
+                ensure_dir_exists(meta_dir)
+                setattr(self, name, meta_cls(os.path.join(meta_dir, 'meta.json')))
+
+        return self.__dict__[name]
+
     def _get_root_dir(self):
         """
         Returns path to project's root directory.
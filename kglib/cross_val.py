@@ -1,52 +1,332 @@
+import concurrent.futures
+import copy
+import hashlib
 import json
+import logging
+import multiprocessing
 import os
+import threading
+import time
 
-import numpy as np
-import sklearn.cross_validation
+from .models.base import FeatureMatrix
+from .utils import ensure_dir_exists, lazy_import
+
+np = lazy_import('numpy')
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Feature matrix, folds and test dataframe shared with fold workers.
+# Set once per worker instead of being pickled for every fold.
+_WORKER_DATA = None
+
+
+# Folds path -> lock serializing creation of the folds file
+# by cross-validations running concurrently.
+_FOLDS_LOCKS = {}
+_FOLDS_LOCKS_LOCK = threading.Lock()
+
+
+def _get_folds_lock(path):
+    with _FOLDS_LOCKS_LOCK:
+        return _FOLDS_LOCKS.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def _set_worker_data(matrix, folds, test_dataframe):
+    global _WORKER_DATA  # pylint: disable=global-statement
+    _WORKER_DATA = (matrix, folds, test_dataframe)
+
+
+def _fit_and_score_in_worker(model, metric, run_idx, fold_idx):
+    matrix, folds, test_dataframe = _WORKER_DATA
+    return _fit_and_score(model, metric, matrix, folds[run_idx], fold_idx, test_dataframe)
+
+
+def get_fold_positions(assignment, fold_idx):
+    """Return (train, test) row positions of a fold given a run's fold assignment."""
+    test_mask = np.asarray(assignment) == fold_idx
+    return np.flatnonzero(~test_mask), np.flatnonzero(test_mask)
+
+
+def get_folds_digest(folds):
+    """A digest of a folds array to tell whether predictions were made on the same folds."""
+    hasher = hashlib.sha1()
+    hasher.update(str(folds.shape).encode())
+    hasher.update(np.ascontiguousarray(folds).tobytes())
+    return hasher.hexdigest()
+
+
+def _fit_and_score(model, metric, matrix, assignment, fold_idx, test_dataframe=None):
+    """
+    Fit the model on a single fold.
+
+    Returns:
+        A tuple of score, elapsed seconds, predictions for the fold's test rows
+        and predictions for test_dataframe (None if it isn't given).
+    """
+
+    start_time = time.time()
+
+    train_pos, test_pos = get_fold_positions(assignment, fold_idx)
+
+    model.fit_matrix(matrix, train_pos, test_pos)
+
+    y_true = matrix.y[test_pos]
+    y_pred = model.predict_matrix(matrix, test_pos)
+
+    score = metric(y_true, y_pred)
+
+    test_pred = None
+    if test_dataframe is not None:
+        test_pred = model.predict(test_dataframe).values
+
+    return score, time.time() - start_time, y_pred, test_pred
 
 
 class CrossValidator:
 
-    def __init__(self, model, dataset_name, target_col, metric):
+    # Whether run() takes a FeatureMatrix of the dataset.
+    uses_feature_matrix = True
+
+    def __init__(self, model, dataset_name, target_col, metric, *, n_jobs=1, n_threads=None,
+                 cv_id=None, test_dataset_name=None):
+        """
+        Args:
+            n_jobs: Number of folds fitted in parallel processes.
+                Workers are fresh processes receiving a copy of the data.
+            n_threads: Number of threads each model may use.
+                Defaults to an even share of CPUs between jobs.
+            cv_id: If set, out-of-fold predictions are saved under this name.
+            test_dataset_name: If set along with cv_id, each fold model
+                predicts this dataset and the predictions are saved as well.
+        """
         self.model = model
         self.dataset_name = dataset_name
         self.target_col = target_col
         self.metric = metric
+        self.n_jobs = n_jobs
+        self.n_threads = n_threads
+        self.cv_id = cv_id
+        self.test_dataset_name = test_dataset_name
+
+    def __str__(self):
+        string = '{} {}'.format(self.__class__.__name__, self.dataset_name)
+        if self.cv_id is not None:
+            string += ' -> {}'.format(self.cv_id)
+        return string
 
-    def run(self, dataframe, meta):
+    def get_fingerprint(self, input_fingerprints, meta):
         """
-        Fit and score the model on all folds.
+        A digest identifying predictions of the cross-validation or None if they can't be cached.
+
+        It changes whenever the model class or its parameters, the metric, the target,
+        the input datasets or the folds change.
         """
+        folds_digest = self._get_saved_folds_digest(meta)
+        if self.cv_id is None or folds_digest is None:
+            return None
+
+        try:
+            model_params = json.dumps(self.model.fingerprint_params, sort_keys=True)
+        except TypeError:
+            return None
 
-        folds = self._get_or_create_folds(dataframe, meta)
+        parts = [
+            '{}.{}'.format(self.__class__.__module__, self.__class__.__name__),
+            '{}.{}'.format(self.model.__class__.__module__, self.model.__class__.__name__),
+            model_params,
+            '{}.{}'.format(getattr(self.metric, '__module__', ''),
+                           getattr(self.metric, '__qualname__', repr(self.metric))),
+            self.target_col,
+            folds_digest,
+        ]
+        parts.extend(input_fingerprints)
 
-        scores = []
+        hasher = hashlib.sha1()
+        for part in parts:
+            hasher.update(part.encode())
+            hasher.update(b'\0')
+        return hasher.hexdigest()
 
-        for per_run_folds in folds:
-            for train_idx, test_idx in per_run_folds:
-                train_df = dataframe.ix[train_idx]
-                test_df = dataframe.ix[test_idx]
+    def is_cached(self, input_fingerprints, meta):
+        """Whether predictions saved under cv_id were made by the same cross-validation."""
+        fingerprint = self.get_fingerprint(input_fingerprints, meta)
+        predictions = meta.predictions.get(self.cv_id) if fingerprint is not None else None
+        if predictions is None or predictions.get('fingerprint') != fingerprint:
+            return False
+        filenames = [predictions['oof_filename'], predictions['test_filename']]
+        return all(os.path.exists(os.path.join(meta.directory, filename))
+                   for filename in filenames if filename is not None)
 
-                self.model.fit(self.target_col, train_df, test_df)
+    def _get_saved_folds_digest(self, meta):
+        folds_path = os.path.join(meta.directory, meta.folds_filename)
+        if not os.path.exists(folds_path):
+            return None
+        return get_folds_digest(self._load_folds(folds_path))
 
-                y_true = test_df[self.target_col]
-                y_pred = self.model.predict(test_df.drop(self.target_col, axis=1))
+    def run(self, dataframe, meta, matrix=None, test_dataframe=None, input_fingerprints=None):
+        """
+        Fit and score the model on all folds.
+
+        A FeatureMatrix of the dataframe may be passed to share it with other actions.
+        Fingerprints of input datasets identify saved predictions, see is_cached().
+        """
 
-                score = self.metric(y_true, y_pred)
-                print(score)
+        if matrix is None:
+            matrix = FeatureMatrix(dataframe, self.target_col)
 
-                scores.append(score)
+        folds = self.get_or_create_folds(dataframe, meta)
+        fold_ids = self.get_fold_ids(folds)
+        model = self.model
+        if self.n_jobs > 1 or self.n_threads is not None:
+            # Thread settings are applied to a copy to keep the configured model intact.
+            model = copy.deepcopy(model)
+        tasks = [(model, run_idx, fold_idx) for run_idx, fold_idx in fold_ids]
+
+        if self.cv_id is None:
+            test_dataframe = None
+        results = self._score_folds(matrix, folds, tasks, test_dataframe)
+        scores = [score for score, _, _, _ in results]
+
+        if self.cv_id is not None:
+            fingerprint = None
+            if input_fingerprints is not None:
+                fingerprint = self.get_fingerprint(input_fingerprints, meta)
+            self._save_predictions(meta, folds, fold_ids, results, fingerprint)
+
+        for score in scores:
+            print(score)
 
         print('Mean: {:.5f}'.format(np.mean(scores)))
         print('Std:  {:.5f}'.format(np.std(scores)))
 
-    def _get_or_create_folds(self, dataframe, meta):
-        """Load folds from file or generate new ones if file doesn't exist."""
+    @staticmethod
+    def get_n_folds(folds):
+        """Number of folds per run in a fold assignment array."""
+        return int(folds.max()) + 1 if folds.size else 0
+
+    @classmethod
+    def get_fold_ids(cls, folds):
+        """Return (run, fold) pairs of all folds in order."""
+        return [(run_idx, fold_idx)
+                for run_idx in range(folds.shape[0])
+                for fold_idx in range(cls.get_n_folds(folds))]
+
+    def _score_folds(self, matrix, folds, tasks, test_dataframe=None):
+        """
+        Fit and score models on folds.
+
+        Args:
+            matrix: FeatureMatrix to take rows from.
+            folds: Fold assignment array.
+            tasks: A list of (model, run_idx, fold_idx).
+            test_dataframe: A dataframe to predict by each fold model or None.
+
+        Returns:
+            A list of _fit_and_score() results in task order.
+        """
+        if self.n_jobs > 1:
+            return self._score_folds_parallel(matrix, folds, tasks, test_dataframe)
+        return self._score_folds_serial(matrix, folds, tasks, test_dataframe)
+
+    def _score_folds_serial(self, matrix, folds, tasks, test_dataframe):
+        results = []
+        for model, run_idx, fold_idx in tasks:
+            if self.n_threads is not None:
+                model.set_n_threads(self.n_threads)
+            results.append(_fit_and_score(model, self.metric, matrix, folds[run_idx], fold_idx,
+                                          test_dataframe))
+        return results
+
+    def _score_folds_parallel(self, matrix, folds, tasks, test_dataframe):
+        """
+        Fit folds in a process pool.
+
+        Workers are started fresh rather than forked: forking isn't safe
+        from non-main threads or after the parent has started thread pools
+        (e.g. OpenMP while building a DMatrix). They get the data once through the initializer.
+        """
+
+        n_threads = self.n_threads or max(1, multiprocessing.cpu_count() // self.n_jobs)
+        for model, _, _ in tasks:
+            model.set_n_threads(n_threads)
+
+        start_methods = multiprocessing.get_all_start_methods()
+        start_method = 'forkserver' if 'forkserver' in start_methods else 'spawn'
+        executor = concurrent.futures.ProcessPoolExecutor(
+            self.n_jobs, mp_context=multiprocessing.get_context(start_method),
+            initializer=_set_worker_data, initargs=(matrix, np.asarray(folds), test_dataframe))
+
+        with executor:
+            futures = [executor.submit(_fit_and_score_in_worker, model,
+                                       self.metric, run_idx, fold_idx)
+                       for model, run_idx, fold_idx in tasks]
+            results = [future.result() for future in futures]
+
+        return results
+
+    def _save_predictions(self, meta, folds, fold_ids, results, fingerprint=None):
+        """
+        Save out-of-fold and test predictions and record them in the meta.
+
+        The record holds a digest of the folds to check that stacked
+        predictions share folds and the fingerprint of the cross-validation.
+
+        Out-of-fold predictions are an (n_runs, n_rows) array aligned with the folds.
+        Test predictions are an (n_runs * n_folds, n_test_rows) array in fold order.
+        """
+
+        predictions_dir = os.path.join(meta.directory, 'predictions')
+        ensure_dir_exists(predictions_dir)
+
+        oof = np.full(folds.shape, np.nan, dtype=np.float32)
+        for (run_idx, fold_idx), (_, _, y_pred, _) in zip(fold_ids, results):
+            _, test_pos = get_fold_positions(folds[run_idx], fold_idx)
+            oof[run_idx, test_pos] = y_pred
+
+        oof_filename = os.path.join('predictions', '{}.oof.npy'.format(self.cv_id))
+        np.save(os.path.join(meta.directory, oof_filename), oof)
+
+        test_filename = None
+        test_preds = [test_pred for _, _, _, test_pred in results]
+        if test_preds and test_preds[0] is not None:
+            test_filename = os.path.join('predictions', '{}.test.npy'.format(self.cv_id))
+            np.save(os.path.join(meta.directory, test_filename),
+                    np.vstack(test_preds).astype(np.float32))
+
+        meta.add_predictions(self.cv_id, {
+            'dataset_name': self.dataset_name,
+            'target_col': self.target_col,
+            'folds_filename': meta.folds_filename,
+            'folds_digest': get_folds_digest(folds),
+            'fingerprint': fingerprint,
+            'oof_filename': oof_filename,
+            'test_dataset_name': self.test_dataset_name if test_filename else None,
+            'test_filename': test_filename,
+        })
+
+    def get_or_create_folds(self, dataframe, meta):
+        """
+        Load folds from file or generate new ones if file doesn't exist.
+
+        Concurrent cross-validations of a process share the folds created by the first one.
+        """
 
         folds_path = os.path.join(meta.directory, meta.folds_filename)
 
+        with _get_folds_lock(folds_path):
+            return self._get_or_create_folds(dataframe, meta, folds_path)
+
+    def _get_or_create_folds(self, dataframe, meta, folds_path):
         if os.path.exists(folds_path):
             folds = self._load_folds(folds_path)
+            assert folds.shape[1] == len(dataframe), 'Folds were generated for another dataset'
+            n_runs, n_folds = folds.shape[0], self.get_n_folds(folds)
+            if (n_runs, n_folds) != (meta.n_runs, meta.n_folds):
+                # The file wins: predictions and scores must match the folds actually used.
+                LOGGER.warning('%s has %d runs of %d folds while meta asks for %d runs of %d folds',
+                               folds_path, n_runs, n_folds, meta.n_runs, meta.n_folds)
         else:
             folds = self._gen_folds(dataframe, meta.n_runs, meta.n_folds)
             self._save_folds(folds, folds_path)
@@ -54,45 +334,39 @@ class CrossValidator:
         return folds
 
     def _load_folds(self, path):
-        """Save folds to file."""
-        with open(path) as folds_file:
-            folds = json.load(folds_file)
-        return folds
+        """Load folds from file."""
+        return np.load(path, mmap_mode='r')
 
     def _save_folds(self, folds, path):
-        """Load folds from file."""
-        with open(path, 'w') as folds_file:
-            json.dump(folds, folds_file)
+        """Save folds to file atomically, so that readers never see a partial file."""
+        tmp_path = '{}.tmp'.format(path)
+        # numpy appends .npy to file names, write through a file object instead.
+        with open(tmp_path, 'wb') as dst:
+            np.save(dst, folds)
+        os.replace(tmp_path, path)
 
     def _gen_folds(self, dataframe, n_runs, n_folds):
         """
         Create new folds.
 
         Args:
-            dataframe: pandas.DataFrame used to derive indexes.
+            dataframe: pandas.DataFrame to split.
             n_runs: Number of runs.
             n_folds: Number of folds per run.
 
         Returns:
-            A list containing folds for each run.
-            Folds for a run are a list of (train, test) index pairs.
+            An (n_runs, n_rows) array. Each row assigns a test fold
+            to every dataframe row by its position.
         """
 
-        assert dataframe.index.is_integer(), 'Only integer indexes are expected'
+        n_rows = len(dataframe)
+        dtype = np.int8 if n_folds <= np.iinfo(np.int8).max else np.int32
 
-        runs = []
+        folds = np.empty((n_runs, n_rows), dtype=dtype)
 
-        for _ in range(n_runs):
-            folds = []
-            fold_idxs = sklearn.cross_validation.KFold(dataframe.index.size,
-                                                       n_folds=n_folds,
-                                                       shuffle=True)
-            for train_idx, test_idx in fold_idxs:
-                # Convert indexes to native types for smooth serialization.
-                train_df_ix = dataframe.index[train_idx].map(int).tolist()
-                test_df_ix = dataframe.index[test_idx].map(int).tolist()
-                pair = (train_df_ix, test_df_ix)
-                folds.append(pair)
-            runs.append(folds)
+        for run_idx in range(n_runs):
+            permutation = np.random.permutation(n_rows)
+            for fold_idx, positions in enumerate(np.array_split(permutation, n_folds)):
+                folds[run_idx, positions] = fold_idx
 
-        return runs
+        return folds
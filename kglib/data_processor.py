@@ -1,7 +1,11 @@
+import functools
+import hashlib
+import inspect
+import json
 import logging
 import time
 
-from .datasets import PandasCsvDataset
+from .datasets import PandasCsvDataset, get_dtype_names, infer_compact_dtypes
 
 
 LOGGER = logging.getLogger(__name__)
@@ -11,7 +15,30 @@ class DataProcessor:
 
     dataset_type = PandasCsvDataset
 
-    def __init__(self, inputs, outputs, **kwargs):
+    # Whether each output is computed row by row from the corresponding input.
+    # Such processors can be applied to inputs chunk by chunk.
+    row_local = False
+
+    # Keyword arguments not affecting outputs (e.g. parallelism), left out of the fingerprint.
+    runtime_kwargs = ()
+
+    # Bump to invalidate cached outputs after changing code the fingerprint can't see,
+    # i.e. outside of modules defining the processor class and its bases.
+    version = 1
+
+    def __init__(self, inputs, outputs, *, dataset_type=None, compact_dtypes=False,
+                 fingerprint_key=None, **kwargs):
+        """
+        Args:
+            dataset_type: Output dataset class overriding the default one.
+            compact_dtypes: Whether to store outputs with smaller dtypes,
+                see datasets.infer_compact_dtypes(). A dict is passed to it as options.
+                Chosen dtypes are saved with dataset parameters, so loads don't infer them.
+                Outputs streamed in chunks aren't compacted.
+            fingerprint_key: A string standing for keyword arguments in the fingerprint.
+                Required if they aren't JSON-serializable (e.g. contain functions).
+            Other keyword arguments are passed to _do_process().
+        """
         # Convert single input/output to a list.
         inputs = [inputs] if isinstance(inputs, str) else list(inputs)
         outputs = [outputs] if isinstance(outputs, str) else list(outputs)
@@ -19,6 +46,13 @@ class DataProcessor:
         self.inputs = inputs
         self.outputs = outputs
 
+        # Allow overriding output format per instance.
+        if dataset_type is not None:
+            self.dataset_type = dataset_type
+
+        self.compact_dtypes = compact_dtypes
+        self.fingerprint_key = fingerprint_key
+
         self.kwargs = kwargs
 
     def __hash__(self):
@@ -27,6 +61,46 @@ class DataProcessor:
                                    ','.join(self.outputs))
         return hash(str_id)
 
+    def get_fingerprint(self, input_fingerprints):
+        """
+        A digest identifying the outputs of the processor.
+
+        It changes whenever the processor class, its version, the source of
+        modules defining it and its bases, arguments except runtime_kwargs,
+        output format or input data change.
+        """
+        cls = self.__class__
+
+        if self.fingerprint_key is not None:
+            kwargs_key = self.fingerprint_key
+        else:
+            try:
+                kwargs = {key: value for key, value in self.kwargs.items()
+                          if key not in self.runtime_kwargs}
+                kwargs_key = json.dumps(kwargs, sort_keys=True)
+            except TypeError:
+                raise ValueError('Arguments of {} aren\'t JSON-serializable, '
+                                 'pass fingerprint_key to identify them'.format(self))
+
+        parts = [
+            '{}.{}'.format(cls.__module__, cls.__name__),
+            str(cls.version),
+            _get_source_digest(cls),
+            kwargs_key,
+            '{}.{}'.format(self.dataset_type.__module__, self.dataset_type.__name__),
+            ','.join(self.inputs),
+            ','.join(self.outputs),
+        ]
+        if self.compact_dtypes:
+            parts.append(json.dumps(self.compact_dtypes, sort_keys=True))
+        parts.extend(input_fingerprints)
+
+        hasher = hashlib.sha1()
+        for part in parts:
+            hasher.update(part.encode())
+            hasher.update(b'\0')
+        return hasher.hexdigest()
+
     def __str__(self):
         string = '{} {} -> {}'.format(
             self.__class__.__name__,
@@ -51,6 +125,27 @@ class DataProcessor:
 
         return output_dataframes
 
+    def process_chunks(self, chunks):
+        """
+        Apply a row-local processor to chunks of a single input.
+
+        Yields output chunks.
+        """
+
+        assert self.row_local, '{} is not row-local'.format(self)
+
+        self._log_processing_start(LOGGER)
+
+        start_time = time.time()
+
+        for chunk in chunks:
+            output_chunk, = self._do_process([chunk], **self.kwargs)
+            yield output_chunk
+
+        end_time = time.time()
+
+        LOGGER.info('Elapsed time: %.2f seconds', end_time - start_time)
+
     def _log_processing_start(self, logger):
         log_fmt = 'Applying %s'
         log_args = [str(self)]
@@ -64,6 +159,14 @@ class DataProcessor:
     def _do_process(self, dataframes, **kwargs):
         raise NotImplementedError
 
+    def get_input_columns(self):
+        """
+        Columns used from each input dataset.
+
+        None means that all columns are needed.
+        """
+        return [None] * len(self.inputs)
+
     def get_dataset_params(self, dataframes):
         """Parameters for each output dataset."""
         assert len(dataframes) == len(self.outputs)
@@ -73,17 +176,39 @@ class DataProcessor:
     def _get_generic_dataset_params(self, dataframe):
         """Common dataframe parameters derived from dataframe characteristics."""
 
-        params = {
-            'dataframe': dataframe,
-            'read_csv_params': {},
-            'to_csv_params': {},
-        }
-
-        # Remember index column for natural index.
-        # Don't write index column for surrogate index.
-        if dataframe.index.name:
-            params['read_csv_params']['index_col'] = dataframe.index.name
-        else:
-            params['to_csv_params']['index'] = False
+        if self.compact_dtypes:
+            dataframe = self._compact_dataframe(dataframe)
 
+        params = self.dataset_type.params_from_dataframe(dataframe)
+        if self.compact_dtypes:
+            params = self.dataset_type.params_with_dtypes(params, get_dtype_names(dataframe))
+        params['dataframe'] = dataframe
         return params
+
+    def _compact_dataframe(self, dataframe):
+        options = self.compact_dtypes if isinstance(self.compact_dtypes, dict) else {}
+        dtypes = infer_compact_dtypes(dataframe, **options)
+        if not dtypes:
+            return dataframe
+
+        LOGGER.info('Compacting %s columns of %s', len(dtypes), self)
+        return dataframe.astype(dtypes)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_source_digest(cls):
+    """A digest of sources of modules defining a class and its bases, including their helpers."""
+    hasher = hashlib.sha1()
+    seen = set()
+    for klass in cls.__mro__:
+        module = inspect.getmodule(klass)
+        if module is None or module in seen or klass is object:
+            continue
+        seen.add(module)
+        try:
+            source = inspect.getsource(module)
+        except (OSError, TypeError):
+            source = ''
+        hasher.update(source.encode())
+        hasher.update(b'\0')
+    return hasher.hexdigest()
@@ -1,6 +1,13 @@
-import pandas as pd
+import hashlib
+import json
+import os
 
 from . import utils
+from .sparse import SparseFrame
+
+np = utils.lazy_import('numpy')
+pd = utils.lazy_import('pandas')
+scipy_sparse = utils.lazy_import('scipy.sparse')
 
 
 class PandasDataset:
@@ -8,14 +15,105 @@ class PandasDataset:
 
     default_extension = ''
 
-    def __init__(self, filename, *, dataframe=None):
+    def __init__(self, filename, *, dataframe=None, compact_dtypes=False):
+        """
+        Args:
+            compact_dtypes: Whether to convert loaded dataframes to smaller dtypes,
+                see infer_compact_dtypes(). A dict is passed to it as options.
+                Meant for source datasets, processors compact their outputs themselves.
+        """
         self.filename = utils.ensure_extension(filename, self.default_extension)
         self._dataframe = dataframe
+        self._fingerprint = None
+        self.compact_dtypes = compact_dtypes
 
     @property
     def dataframe(self):
         raise NotImplementedError
 
+    @property
+    def fingerprint(self):
+        """
+        A digest identifying the dataset contents.
+
+        Produced datasets get the fingerprint of the processor that created them.
+        Other datasets are identified by file stats or by contents if not saved
+        and by dtype compaction options if enabled.
+        """
+        if self._fingerprint is None:
+            hasher = hashlib.sha1()
+            if os.path.exists(self.filename):
+                stat = os.stat(self.filename)
+                hasher.update('{}:{}:{}'.format(os.path.abspath(self.filename),
+                                                stat.st_size, stat.st_mtime).encode())
+            else:
+                hashes = pd.util.hash_pandas_object(self.dataframe)
+                hasher.update(hashes.values.tobytes())
+            if self.compact_dtypes:
+                hasher.update(json.dumps(self.compact_dtypes, sort_keys=True).encode())
+            self._fingerprint = hasher.hexdigest()
+        return self._fingerprint
+
+    @fingerprint.setter
+    def fingerprint(self, value):
+        self._fingerprint = value
+
+    def get_dataframe(self, columns=None):
+        """
+        Return the dataframe optionally restricted to a subset of columns.
+
+        Formats that support it read only the requested columns from disk.
+        Projected dataframes aren't cached.
+        """
+        if columns is None:
+            return self.dataframe
+        if self._dataframe is not None:
+            return self._dataframe[list(columns)]
+        return self._compact_loaded(self._load_columns(columns))
+
+    def _load_columns(self, columns):
+        return self.dataframe[list(columns)]
+
+    def _compact_loaded(self, dataframe):
+        """Convert a loaded dataframe to smaller dtypes if enabled."""
+        if not self.compact_dtypes:
+            return dataframe
+        options = self.compact_dtypes if isinstance(self.compact_dtypes, dict) else {}
+        dtypes = infer_compact_dtypes(dataframe, **options)
+        if dtypes:
+            dataframe = dataframe.astype(dtypes)
+        return dataframe
+
+    def iter_chunks(self, chunk_size, columns=None):
+        """
+        Iterate over the dataframe in chunks of rows.
+
+        At least one (possibly empty) chunk is yielded.
+        """
+        dataframe = self.get_dataframe(columns)
+        yield dataframe.iloc[:chunk_size]
+        for start in range(chunk_size, len(dataframe), chunk_size):
+            yield dataframe.iloc[start:start + chunk_size]
+
+    def save_chunks(self, chunks):
+        """
+        Save a dataframe given as an iterable of chunks of rows.
+
+        No chunks make an empty dataframe, the file is written anyway
+        so that the dataset isn't considered missing.
+        """
+        chunks = list(chunks)
+        self._dataframe = pd.concat(chunks) if chunks else pd.DataFrame()
+        self.save()
+
+    def save(self):
+        raise NotImplementedError
+
+    def release(self):
+        """Free the in-memory dataframe if it can be loaded again from file."""
+        if os.path.exists(self.filename):
+            self._dataframe = None
+
     def __str__(self):
         string = '{} at {}'.format(self.__class__.__name__, self.filename)
         return string
@@ -25,6 +123,20 @@ class PandasDataset:
         """Keyword arguments to reinstantiate the dataset."""
         return {}
 
+    @classmethod
+    def params_from_dataframe(cls, dataframe):
+        """Dataset parameters derived from dataframe characteristics."""
+        return {}
+
+    @classmethod
+    def params_with_dtypes(cls, params, dtypes):
+        """
+        Add dtypes to restore on load to dataset parameters.
+
+        Formats storing dtypes along with the data need nothing.
+        """
+        return params
+
     def copy_to(self, other):
         """Make another dataset a copy of this one."""
         raise NotImplementedError
@@ -34,15 +146,17 @@ class PandasCsvDataset(PandasDataset):
 
     default_extension = 'csv'
 
-    def __init__(self, filename, *, read_csv_params=None, to_csv_params=None, dataframe=None):
-        super().__init__(filename, dataframe=dataframe)
+    def __init__(self, filename, *, read_csv_params=None, to_csv_params=None, dataframe=None,
+                 compact_dtypes=False):
+        super().__init__(filename, dataframe=dataframe, compact_dtypes=compact_dtypes)
         self.read_csv_params = read_csv_params or {}
         self.to_csv_params = to_csv_params or {}
 
     @property
     def dataframe(self):
         if self._dataframe is None:
-            self._dataframe = self._load_dataframe(self.filename, **self.read_csv_params)
+            dataframe = self._load_dataframe(self.filename, **self.read_csv_params)
+            self._dataframe = self._compact_loaded(dataframe)
         return self._dataframe
 
     @property
@@ -52,9 +166,94 @@ class PandasCsvDataset(PandasDataset):
             'to_csv_params': self.to_csv_params,
         }
 
+    @classmethod
+    def params_from_dataframe(cls, dataframe):
+        params = {
+            'read_csv_params': {},
+            'to_csv_params': {},
+        }
+
+        # Remember index column for natural index.
+        # Don't write index column for surrogate index.
+        if dataframe.index.name:
+            params['read_csv_params']['index_col'] = dataframe.index.name
+        else:
+            params['to_csv_params']['index'] = False
+
+        return params
+
+    @classmethod
+    def params_with_dtypes(cls, params, dtypes):
+        # Passing dtypes to read_csv also skips their inference.
+        params['read_csv_params']['dtype'] = dict(dtypes)
+        return params
+
     def __str__(self):
         return self.filename
 
+    def _compact_loaded(self, dataframe):
+        dataframe = super()._compact_loaded(dataframe)
+        if self.compact_dtypes:
+            # Parse the same columns with chosen dtypes next time instead of inferring them.
+            dtypes = dict(self.read_csv_params.get('dtype') or {})
+            dtypes.update(get_dtype_names(dataframe))
+            self.read_csv_params = dict(self.read_csv_params, dtype=dtypes)
+        return dataframe
+
+    def _load_columns(self, columns):
+        params = dict(self.read_csv_params)
+        index_col = params.get('index_col')
+        if index_col is not None and not isinstance(index_col, str):
+            # Positional index columns can't be combined with usecols.
+            return super()._load_columns(columns)
+
+        usecols = list(columns)
+        if index_col is not None and index_col not in usecols:
+            usecols.append(index_col)
+        params['usecols'] = usecols
+
+        dataframe = self._load_dataframe(self.filename, **params)
+        return dataframe[list(columns)]
+
+    def iter_chunks(self, chunk_size, columns=None):
+        if self._dataframe is not None:
+            yield from super().iter_chunks(chunk_size, columns)
+            return
+
+        params = dict(self.read_csv_params)
+        index_col = params.get('index_col')
+        if columns is not None:
+            usecols = list(columns)
+            if isinstance(index_col, str) and index_col not in usecols:
+                usecols.append(index_col)
+            params['usecols'] = usecols
+
+        empty = True
+        for chunk in self._load_dataframe(self.filename, chunksize=chunk_size, **params):
+            empty = False
+            yield chunk if columns is None else chunk[list(columns)]
+
+        if empty:
+            chunk = self._load_dataframe(self.filename, nrows=0, **params)
+            yield chunk if columns is None else chunk[list(columns)]
+
+    def save_chunks(self, chunks):
+        """
+        Append chunks to the file one by one without keeping them in memory.
+
+        No chunks make a file with an empty header.
+        """
+        empty = True
+        for chunk in chunks:
+            params = dict(self.to_csv_params)
+            if not empty:
+                params.update(mode='a', header=False)
+            self._save_dataframe(chunk, self.filename, **params)
+            empty = False
+
+        if empty:
+            self._save_dataframe(pd.DataFrame(), self.filename, **self.to_csv_params)
+
     @staticmethod
     def _load_dataframe(filename, **kwargs):
         return pd.read_csv(filename, **kwargs)
@@ -75,3 +274,402 @@ class PandasCsvDataset(PandasDataset):
     def load(cls, filename, **kwargs):
         obj = cls(filename, **kwargs)
         return obj
+
+
+class PandasColumnarDataset(PandasDataset):
+    """
+    A base class for binary columnar formats.
+
+    Unlike CSV these formats preserve column dtypes
+    and allow reading a subset of columns.
+    """
+
+    def __init__(self, filename, *, read_params=None, write_params=None, dataframe=None,
+                 compact_dtypes=False):
+        super().__init__(filename, dataframe=dataframe, compact_dtypes=compact_dtypes)
+        self.read_params = read_params or {}
+        self.write_params = write_params or {}
+
+    @property
+    def dataframe(self):
+        if self._dataframe is None:
+            dataframe = self._load_dataframe(self.filename, **self.read_params)
+            self._dataframe = self._compact_loaded(dataframe)
+        return self._dataframe
+
+    @property
+    def params(self):
+        return {
+            'read_params': self.read_params,
+            'write_params': self.write_params,
+        }
+
+    def __str__(self):
+        return self.filename
+
+    def _load_columns(self, columns):
+        return self._load_dataframe(self.filename, columns=list(columns), **self.read_params)
+
+    @staticmethod
+    def _load_dataframe(filename, **kwargs):
+        raise NotImplementedError
+
+    @staticmethod
+    def _save_dataframe(dataframe, filename, **kwargs):
+        raise NotImplementedError
+
+    def copy_to(self, other):
+        other.read_params = self.read_params
+        other.write_params = self.write_params
+        other._dataframe = self.dataframe.copy()
+
+    def save(self):
+        self._save_dataframe(self.dataframe, self.filename, **self.write_params)
+
+    @classmethod
+    def load(cls, filename, **kwargs):
+        obj = cls(filename, **kwargs)
+        return obj
+
+
+class PandasParquetDataset(PandasColumnarDataset):
+    """A dataset stored in Apache Parquet format. Index is stored along with the data."""
+
+    default_extension = 'parquet'
+
+    @staticmethod
+    def _load_dataframe(filename, **kwargs):
+        return pd.read_parquet(filename, **kwargs)
+
+    @staticmethod
+    def _save_dataframe(dataframe, filename, **kwargs):
+        dataframe.to_parquet(filename, **kwargs)
+
+
+class PandasFeatherDataset(PandasColumnarDataset):
+    """
+    A dataset stored in Feather format.
+
+    Feather can't store an index so a natural index is saved
+    as a regular column and restored on load.
+    """
+
+    default_extension = 'feather'
+
+    def __init__(self, filename, *, index_col=None, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.index_col = index_col
+
+    @property
+    def dataframe(self):
+        if self._dataframe is None:
+            dataframe = self._load_dataframe(self.filename, **self.read_params)
+            self._dataframe = self._compact_loaded(self._restore_index(dataframe))
+        return self._dataframe
+
+    @property
+    def params(self):
+        params = super().params
+        params['index_col'] = self.index_col
+        return params
+
+    @classmethod
+    def params_from_dataframe(cls, dataframe):
+        return {'index_col': dataframe.index.name}
+
+    def _load_columns(self, columns):
+        columns = list(columns)
+        read_columns = columns
+        if self.index_col is not None and self.index_col not in columns:
+            read_columns = columns + [self.index_col]
+        dataframe = self._load_dataframe(self.filename, columns=read_columns, **self.read_params)
+        return self._restore_index(dataframe)[columns]
+
+    def _restore_index(self, dataframe):
+        if self.index_col is not None:
+            dataframe = dataframe.set_index(self.index_col)
+        return dataframe
+
+    def copy_to(self, other):
+        super().copy_to(other)
+        other.index_col = self.index_col
+
+    def save(self):
+        # Feather requires a default index.
+        dataframe = self.dataframe.reset_index(drop=self.index_col is None)
+        self._save_dataframe(dataframe, self.filename, **self.write_params)
+
+    @staticmethod
+    def _load_dataframe(filename, **kwargs):
+        return pd.read_feather(filename, **kwargs)
+
+    @staticmethod
+    def _save_dataframe(dataframe, filename, **kwargs):
+        dataframe.to_feather(filename, **kwargs)
+
+
+class NumpyMemmapDataset(PandasDataset):
+    """
+    A dataset of numeric columns stored as a single .npy matrix.
+
+    The matrix is stored in column-major order and memory-mapped on load,
+    so columns are paged in on demand and the file's pages are shared
+    between processes reading it. The dataframe is a view of the mapped matrix.
+    """
+
+    default_extension = 'npy'
+
+    def __init__(self, filename, *, columns=None, dtype='float64', index_col=None,
+                 stored_index=False, mmap_mode='r', dataframe=None):
+        super().__init__(filename, dataframe=dataframe)
+        self.columns = list(columns) if columns is not None else None
+        self.dtype = dtype
+        self.index_col = index_col
+        self.stored_index = stored_index
+        self.mmap_mode = mmap_mode
+
+    @property
+    def index_filename(self):
+        base, ext = os.path.splitext(self.filename)
+        return '{}.index{}'.format(base, ext)
+
+    @property
+    def dataframe(self):
+        if self._dataframe is None:
+            matrix = self._load_matrix()
+            self._dataframe = pd.DataFrame(matrix, index=self._load_index(),
+                                           columns=self.columns, copy=False)
+        return self._dataframe
+
+    @property
+    def params(self):
+        return {
+            'columns': self.columns,
+            'dtype': self.dtype,
+            'index_col': self.index_col,
+            'stored_index': self.stored_index,
+            'mmap_mode': self.mmap_mode,
+        }
+
+    @classmethod
+    def params_from_dataframe(cls, dataframe):
+        cls._check_dataframe(dataframe)
+        params = {
+            'columns': dataframe.columns.tolist(),
+            'dtype': str(np.result_type(*dataframe.dtypes)),
+            'index_col': dataframe.index.name,
+            # A default index is cheaper to rebuild than to store.
+            'stored_index': not isinstance(dataframe.index, pd.RangeIndex),
+        }
+        return params
+
+    def __str__(self):
+        return self.filename
+
+    @staticmethod
+    def _check_dataframe(dataframe):
+        """
+        Raise ValueError for dataframes that can't be stored as a numeric matrix.
+
+        Non-numeric columns would make the whole matrix an object one
+        that can't be memory-mapped and a non-numeric index can't be mapped either.
+        """
+        if dataframe.shape[0] == 0 or dataframe.shape[1] == 0:
+            raise ValueError('Can\'t store an empty dataframe of shape {} as a matrix'.format(dataframe.shape))
+
+        non_numeric = [col for col, dtype in dataframe.dtypes.items() if dtype.kind not in 'biuf']
+        if non_numeric:
+            raise ValueError('Columns {} are not numeric and can\'t be stored as a matrix'.format(non_numeric))
+
+        index = dataframe.index
+        if not isinstance(index, pd.RangeIndex) and index.dtype.kind not in 'biuf':
+            raise ValueError('Index of dtype {} is not numeric and can\'t be stored'.format(index.dtype))
+
+    def _load_matrix(self):
+        return np.load(self.filename, mmap_mode=self.mmap_mode)
+
+    def _load_index(self):
+        if self.stored_index:
+            values = np.load(self.index_filename, mmap_mode=self.mmap_mode)
+            return pd.Index(values, name=self.index_col)
+        return None
+
+    def _load_columns(self, columns):
+        positions = [self.columns.index(col) for col in columns]
+        # Column-major layout makes this read only the requested columns.
+        matrix = self._load_matrix()[:, positions]
+        return pd.DataFrame(matrix, index=self._load_index(), columns=list(columns), copy=False)
+
+    def copy_to(self, other):
+        other.columns = self.columns
+        other.dtype = self.dtype
+        other.index_col = self.index_col
+        other.stored_index = self.stored_index
+        other._dataframe = self.dataframe.copy()
+
+    def save(self):
+        dataframe = self.dataframe
+        self._check_dataframe(dataframe)
+
+        # Write column by column to avoid materializing a converted copy of the whole frame.
+        matrix = np.lib.format.open_memmap(self.filename, mode='w+', dtype=self.dtype,
+                                           shape=dataframe.shape, fortran_order=True)
+        for i, col in enumerate(dataframe.columns):
+            matrix[:, i] = dataframe[col].values
+        matrix.flush()
+        del matrix
+
+        if self.stored_index:
+            np.save(self.index_filename, dataframe.index.values)
+
+    @classmethod
+    def load(cls, filename, **kwargs):
+        obj = cls(filename, **kwargs)
+        return obj
+
+
+class ScipySparseDataset(PandasDataset):
+    """
+    A dataset of sparse features stored in a .npz archive.
+
+    The dataframe is a SparseFrame: a CSR matrix with an index,
+    sparse column names and dense columns (e.g. the target) kept alongside.
+    Everything is stored in the archive, so the only parameter is compression.
+    """
+
+    default_extension = 'npz'
+
+    def __init__(self, filename, *, compressed=False, dataframe=None):
+        super().__init__(filename, dataframe=dataframe)
+        self.compressed = compressed
+
+    @property
+    def dataframe(self):
+        if self._dataframe is None:
+            self._dataframe = self._load_frame()
+        return self._dataframe
+
+    @property
+    def params(self):
+        return {'compressed': self.compressed}
+
+    def __str__(self):
+        return self.filename
+
+    def _load_frame(self):
+        # Dense object columns and string names are pickled by numpy.
+        with np.load(self.filename, allow_pickle=True) as archive:
+            matrix = scipy_sparse.csr_matrix(
+                (archive['data'], archive['indices'], archive['indptr']),
+                shape=tuple(archive['shape']))
+            index = pd.Index(archive['index'], name=archive['index_name'].item())
+            columns = archive['columns'] if 'columns' in archive.files else None
+            dense_columns = archive['dense_columns'].tolist()
+            dense = pd.DataFrame({col: archive['dense_{}'.format(i)]
+                                  for i, col in enumerate(dense_columns)},
+                                 index=index, columns=dense_columns)
+        return SparseFrame(matrix, index=index, columns=columns, dense=dense)
+
+    def _load_columns(self, columns):
+        return self.dataframe.dense[list(columns)]
+
+    def save_chunks(self, chunks):
+        chunks = list(chunks)
+        self._dataframe = SparseFrame.concat_rows(chunks) if chunks else SparseFrame(np.zeros((0, 0)))
+        self.save()
+
+    def copy_to(self, other):
+        other.compressed = self.compressed
+        frame = self.dataframe
+        other._dataframe = SparseFrame(frame.matrix.copy(), index=frame.index.copy(),
+                                       columns=frame.sparse_columns, dense=frame.dense.copy())
+
+    def save(self):
+        frame = self.dataframe
+        matrix = frame.matrix
+        arrays = {
+            'data': matrix.data,
+            'indices': matrix.indices,
+            'indptr': matrix.indptr,
+            'shape': np.asarray(matrix.shape),
+            'index': frame.index.values,
+            'index_name': np.asarray(frame.index.name, dtype=object),
+            'dense_columns': np.asarray(frame.dense.columns.tolist(), dtype=object),
+        }
+        if frame.sparse_columns is not None:
+            arrays['columns'] = np.asarray(frame.sparse_columns, dtype=object)
+        for i, col in enumerate(frame.dense.columns):
+            arrays['dense_{}'.format(i)] = frame.dense[col].values
+
+        save = np.savez_compressed if self.compressed else np.savez
+        # numpy appends .npz to file names, write through a file object instead.
+        with open(self.filename, 'wb') as dst:
+            save(dst, **arrays)
+
+    @classmethod
+    def load(cls, filename, **kwargs):
+        obj = cls(filename, **kwargs)
+        return obj
+
+
+def infer_compact_dtypes(dataframe, *, max_category_ratio=0.5, downcast_floats=True,
+                         allow_unsigned=False):
+    """
+    Infer smaller dtypes for dataframe columns.
+
+    Integers get the smallest signed integer type holding their range
+    (unsigned for non-negative columns if allow_unsigned is set, beware of
+    wrapping around on subtraction),
+    floats become float32 (about 7 significant digits) and string columns
+    with at most max_category_ratio distinct values per row become categories.
+
+    Returns:
+        A mapping from column name to dtype name for columns to convert.
+    """
+
+    dtypes = {}
+    n_rows = len(dataframe)
+
+    for col in dataframe.columns:
+        series = dataframe[col]
+        kind = series.dtype.kind
+
+        if kind in 'iu' and n_rows:
+            dtype = _get_smallest_int_dtype(series.min(), series.max(), allow_unsigned)
+            if dtype is None:
+                continue
+        elif kind == 'f' and downcast_floats and series.dtype.itemsize > 4:
+            dtype = 'float32'
+        elif (kind == 'O' and n_rows and
+              pd.api.types.infer_dtype(series, skipna=True) == 'string' and
+              series.nunique() <= max_category_ratio * n_rows):
+            dtype = 'category'
+        else:
+            continue
+
+        if dtype != series.dtype.name:
+            dtypes[col] = dtype
+
+    return dtypes
+
+
+def get_dtype_names(dataframe):
+    """Dtype names of numeric, boolean and categorical columns of a dataframe."""
+    dtypes = {}
+    for col, dtype in dataframe.dtypes.items():
+        if dtype.name == 'category' or dtype.kind in 'biuf':
+            dtypes[col] = dtype.name
+    return dtypes
+
+
+def _get_smallest_int_dtype(min_value, max_value, allow_unsigned=False):
+    if allow_unsigned and min_value >= 0:
+        candidates = ['uint8', 'uint16', 'uint32', 'uint64']
+    else:
+        candidates = ['int8', 'int16', 'int32', 'int64']
+    for name in candidates:
+        info = np.iinfo(name)
+        if info.min <= min_value and max_value <= info.max:
+            return name
+    # Large unsigned values don't fit any signed type.
+    return None
@@ -1,4 +1,15 @@
+import concurrent.futures
+import itertools
+
 from .data_processor import DataProcessor
+from .datasets import ScipySparseDataset
+from .sparse import SparseFrame
+from .utils import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+scipy_sparse = lazy_import('scipy.sparse')
+sklearn_text = lazy_import('sklearn.feature_extraction.text')
 
 
 class FeatureExtractor(DataProcessor):
@@ -8,9 +19,385 @@ class FeatureExtractor(DataProcessor):
 
 
 class JoinFeatureExtractor(FeatureExtractor):
+    """
+    Left join all inputs on the index of the first one.
+
+    Inputs are aligned and concatenated at once
+    instead of producing an intermediate frame per join.
+    Inputs with duplicate index values are joined one by one
+    repeating rows of the first input for each match.
+    If any input is a SparseFrame the result is a SparseFrame too
+    and should be saved with dataset_type=ScipySparseDataset.
+    """
 
     def _do_process(self, dataframes):
-        joined = dataframes[0].copy()
+        base = dataframes[0]
+
+        seen = set(self._get_named_columns(base))
         for dataframe in dataframes[1:]:
-            joined = joined.join(dataframe.copy())
+            overlap = seen.intersection(self._get_named_columns(dataframe))
+            if overlap:
+                raise ValueError('Columns overlap: {}'.format(sorted(overlap)))
+            seen.update(self._get_named_columns(dataframe))
+
+        if any(isinstance(dataframe, SparseFrame) for dataframe in dataframes):
+            return self._join_sparse(dataframes),
+
+        if not all(dataframe.index.is_unique for dataframe in dataframes[1:]):
+            # Reindexing can't match duplicates, join does.
+            joined = base
+            for dataframe in dataframes[1:]:
+                joined = joined.join(dataframe)
+            return joined,
+
+        aligned = [base]
+        for dataframe in dataframes[1:]:
+            if not dataframe.index.equals(base.index):
+                dataframe = dataframe.reindex(base.index)
+            aligned.append(dataframe)
+
+        joined = pd.concat(aligned, axis=1, copy=False)
         return joined,
+
+    @staticmethod
+    def _get_named_columns(dataframe):
+        if isinstance(dataframe, SparseFrame):
+            return list(dataframe.dense.columns) + (dataframe.sparse_columns or [])
+        return list(dataframe.columns)
+
+    def _join_sparse(self, dataframes):
+        """
+        Join sparse and dense inputs into a SparseFrame.
+
+        Sparse matrices are stacked horizontally, dense columns are joined as usual.
+        Rows of sparse inputs can't be filled with NaN, so they must
+        contain every row of the first input.
+        """
+        if not issubclass(self.dataset_type, ScipySparseDataset):
+            raise ValueError('Sparse inputs of {} require dataset_type={}'.format(
+                self, ScipySparseDataset.__name__))
+
+        index = dataframes[0].index
+        for dataframe in dataframes[1:]:
+            if not dataframe.index.is_unique:
+                raise ValueError('Can\'t join inputs with duplicate index values into a SparseFrame')
+
+        matrices = []
+        sparse_columns = []
+        dense_parts = []
+
+        for dataframe in dataframes:
+            if isinstance(dataframe, SparseFrame):
+                if not dataframe.index.equals(index):
+                    positions = dataframe.index.get_indexer(index)
+                    if (positions < 0).any():
+                        raise ValueError('Sparse input lacks rows of the first input')
+                    dataframe = dataframe.take(positions)
+                matrices.append(dataframe.matrix)
+                if sparse_columns is not None and dataframe.sparse_columns is not None:
+                    sparse_columns.extend(dataframe.sparse_columns)
+                else:
+                    # Positional names can't be mixed with named ones.
+                    sparse_columns = None
+                dense = dataframe.dense
+            else:
+                dense = dataframe
+            if not dense.index.equals(index):
+                dense = dense.reindex(index)
+            dense_parts.append(dense)
+
+        matrix = scipy_sparse.hstack(matrices, format='csr')
+        dense = pd.concat(dense_parts, axis=1, copy=False)
+        return SparseFrame(matrix, index=index, columns=sparse_columns, dense=dense)
+
+
+class TextVectorizerFeatureExtractor(FeatureExtractor):
+    """
+    A base class for extractors turning a text column into sparse features.
+
+    Each input produces an output SparseFrame with the input's index.
+    Stateful vectorizers are fitted on all inputs together
+    so train and test features share a vocabulary.
+
+    Arguments:
+        column: Text column to vectorize.
+        keep_columns: Dense columns copied to outputs as is (e.g. the target).
+            Columns missing in an input (e.g. the target in a test set) are skipped.
+        prefix: Prefix of feature names. Defaults to '<column>_'.
+        Others are passed to the vectorizer.
+    """
+
+    dataset_type = ScipySparseDataset
+
+    # Whether the vectorizer has to be fitted.
+    stateful = True
+
+    def get_input_columns(self):
+        if self.kwargs.get('keep_columns'):
+            # Columns to keep may be missing in some inputs.
+            return [None] * len(self.inputs)
+        return [[self.kwargs['column']]] * len(self.inputs)
+
+    def _do_process(self, dataframes, *, column, keep_columns=(), prefix=None, **kwargs):
+        if prefix is None:
+            prefix = '{}_'.format(column)
+        if 'ngram_range' in kwargs:
+            # JSON configs give lists.
+            kwargs['ngram_range'] = tuple(kwargs['ngram_range'])
+
+        vectorizer = self._build_vectorizer(**kwargs)
+        texts = [dataframe[column].fillna('').astype(str) for dataframe in dataframes]
+
+        if self.stateful:
+            vectorizer.fit(pd.concat(texts, ignore_index=True))
+        matrices = [vectorizer.transform(text) for text in texts]
+        feature_names = self._get_feature_names(vectorizer)
+        if feature_names is not None:
+            feature_names = [prefix + name for name in feature_names]
+
+        output_frames = []
+        for dataframe, matrix in zip(dataframes, matrices):
+            kept = [col for col in keep_columns if col in dataframe.columns]
+            output_frames.append(SparseFrame(matrix, index=dataframe.index, columns=feature_names,
+                                             dense=dataframe[kept]))
+        return output_frames
+
+    def _build_vectorizer(self, **kwargs):
+        raise NotImplementedError
+
+    @staticmethod
+    def _get_feature_names(vectorizer):
+        if hasattr(vectorizer, 'get_feature_names_out'):
+            return vectorizer.get_feature_names_out().tolist()
+        return vectorizer.get_feature_names()
+
+
+class HashingFeatureExtractor(TextVectorizerFeatureExtractor):
+    """
+    Token or n-gram counts hashed into a fixed number of columns.
+
+    Needs no fitting and no vocabulary, so memory doesn't grow with the corpus.
+    Features have positional names.
+    """
+
+    stateful = False
+    row_local = True
+
+    def _build_vectorizer(self, **kwargs):
+        kwargs.setdefault('n_features', 2 ** 20)
+        kwargs.setdefault('alternate_sign', False)
+        return sklearn_text.HashingVectorizer(**kwargs)
+
+    @staticmethod
+    def _get_feature_names(vectorizer):
+        return None
+
+
+class NgramFeatureExtractor(TextVectorizerFeatureExtractor):
+    """Counts of word or character n-grams, e.g. ngram_range=(1, 2) or analyzer='char_wb'."""
+
+    def _build_vectorizer(self, **kwargs):
+        return sklearn_text.CountVectorizer(**kwargs)
+
+
+class TfidfFeatureExtractor(TextVectorizerFeatureExtractor):
+    """TF-IDF weighted token or n-gram counts. IDF is computed over all inputs."""
+
+    def _build_vectorizer(self, **kwargs):
+        kwargs.setdefault('dtype', np.float32)
+        return sklearn_text.TfidfVectorizer(**kwargs)
+
+
+class TextSimilarityFeatureExtractor(FeatureExtractor):
+    """
+    Similarities between a query and a document text column.
+
+    Each input produces a dataframe of features with the input's index:
+        <prefix>word_overlap: Number of distinct query words found in the document.
+        <prefix>word_overlap_ratio: The same divided by the number of distinct query words.
+        <prefix>jaccard: Jaccard similarity of query and document word sets.
+        <prefix>bm25: Okapi BM25 score of the document for the query.
+            Document frequencies are counted over documents of all inputs.
+        <prefix>char_ngram_cosine: Cosine similarity of character n-gram counts.
+
+    Texts are hashed into sparse token count matrices batch by batch
+    and features are computed on whole matrices at once.
+    With n_jobs > 1 batches are processed by a process pool.
+
+    Arguments:
+        query_col, document_col: Text columns to compare.
+        prefix: Prefix of feature names.
+        n_jobs: Number of worker processes.
+        batch_size: Number of rows per batch.
+        n_features: Number of hash buckets for tokens and n-grams.
+        char_ngram_range: Lengths of character n-grams.
+        k1, b: BM25 parameters.
+    """
+
+    runtime_kwargs = ('n_jobs', 'batch_size')
+
+    def get_input_columns(self):
+        return [[self.kwargs['query_col'], self.kwargs['document_col']]] * len(self.inputs)
+
+    def _do_process(self, dataframes, *, query_col, document_col, prefix='', n_jobs=1,
+                    batch_size=50000, n_features=2 ** 20, char_ngram_range=(3, 3), k1=1.2, b=0.75):
+        params = {
+            'n_features': n_features,
+            'char_ngram_range': tuple(char_ngram_range),
+            'k1': k1,
+            'b': b,
+        }
+
+        batches = []
+        for dataframe in dataframes:
+            queries = dataframe[query_col].fillna('').astype(str).tolist()
+            documents = dataframe[document_col].fillna('').astype(str).tolist()
+            batches.append([(queries[i:i + batch_size], documents[i:i + batch_size])
+                            for i in range(0, len(dataframe), batch_size)])
+        all_batches = list(itertools.chain.from_iterable(batches))
+
+        # Document statistics for BM25 over the whole corpus come first.
+        doc_freqs = np.zeros(n_features, dtype=np.int64)
+        n_docs = 0
+        total_length = 0
+        documents = [docs for _, docs in all_batches]
+        if n_jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+                document_stats = list(executor.map(_get_document_stats, documents,
+                                                   itertools.repeat(n_features)))
+        else:
+            document_stats = [_get_document_stats(docs, n_features) for docs in documents]
+        for words, batch_freqs, batch_docs, batch_length in document_stats:
+            doc_freqs[words] += batch_freqs
+            n_docs += batch_docs
+            total_length += batch_length
+
+        params['idf'] = np.log1p((n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+        params['avg_length'] = total_length / n_docs if n_docs else 0.
+
+        if n_jobs > 1:
+            # Workers get the IDF table once instead of with every batch.
+            with concurrent.futures.ProcessPoolExecutor(
+                    n_jobs, initializer=_init_similarity_worker, initargs=(params,)) as executor:
+                batch_features = list(executor.map(_get_similarity_features, all_batches))
+        else:
+            batch_features = [_get_similarity_features(batch, params) for batch in all_batches]
+
+        output_dataframes = []
+        start = 0
+        for dataframe, input_batches in zip(dataframes, batches):
+            features = batch_features[start:start + len(input_batches)]
+            start += len(input_batches)
+            if features:
+                values = {name: np.concatenate([batch[name] for batch in features])
+                          for name in features[0]}
+            else:
+                values = {name: np.array([], dtype=np.float32) for name in _SIMILARITY_FEATURES}
+            output_df = pd.DataFrame(values, index=dataframe.index, columns=_SIMILARITY_FEATURES)
+            output_dataframes.append(output_df.add_prefix(prefix))
+
+        return output_dataframes
+
+
+_SIMILARITY_FEATURES = ['word_overlap', 'word_overlap_ratio', 'jaccard', 'bm25', 'char_ngram_cosine']
+
+
+def _hash_words(texts, n_features):
+    """Word counts of texts hashed into a CSR matrix."""
+    vectorizer = sklearn_text.HashingVectorizer(n_features=n_features, alternate_sign=False,
+                                                norm=None, dtype=np.float32)
+    return vectorizer.transform(texts)
+
+
+def _hash_char_ngrams(texts, n_features, ngram_range):
+    vectorizer = sklearn_text.HashingVectorizer(n_features=n_features, alternate_sign=False,
+                                                norm=None, dtype=np.float32,
+                                                analyzer='char_wb', ngram_range=ngram_range)
+    return vectorizer.transform(texts)
+
+
+def _row_sums(matrix):
+    return np.asarray(matrix.sum(axis=1), dtype=np.float32).ravel()
+
+
+def _safe_divide(numerator, denominator):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = numerator / denominator
+    ratio[denominator == 0] = 0.
+    return ratio
+
+
+def _get_document_stats(documents, n_features):
+    """
+    Return hashed words found in documents with the number of documents containing each,
+    the number of documents and their total length.
+    """
+    counts = _hash_words(documents, n_features)
+    # Each word counts once per document however many times it occurs.
+    words, doc_freqs = np.unique(counts.indices, return_counts=True)
+    return words, doc_freqs, counts.shape[0], float(counts.sum())
+
+
+# Parameters of similarity features including the IDF table.
+# Set once per worker instead of being pickled for every batch.
+_WORKER_SIMILARITY_PARAMS = None
+
+
+def _init_similarity_worker(params):
+    global _WORKER_SIMILARITY_PARAMS  # pylint: disable=global-statement
+    _WORKER_SIMILARITY_PARAMS = params
+
+
+def _get_similarity_features(batch, params=None):
+    """
+    Compute similarity features of a batch of (queries, documents).
+
+    Params are taken from the worker initializer if not given.
+    """
+    if params is None:
+        params = _WORKER_SIMILARITY_PARAMS
+
+    queries, documents = batch
+    n_rows = len(queries)
+
+    query_counts = _hash_words(queries, params['n_features'])
+    doc_counts = _hash_words(documents, params['n_features'])
+
+    # Distinct words.
+    query_words = query_counts.copy()
+    query_words.data[:] = 1
+    doc_words = doc_counts.copy()
+    doc_words.data[:] = 1
+
+    n_query_words = _row_sums(query_words)
+    n_doc_words = _row_sums(doc_words)
+
+    # Document term frequencies of query words.
+    matched = query_words.multiply(doc_counts).tocsr()
+    matched.eliminate_zeros()
+    overlap = np.diff(matched.indptr).astype(np.float32)
+
+    # BM25 summed over matched entries.
+    doc_lengths = _row_sums(doc_counts)
+    rows = np.repeat(np.arange(n_rows), np.diff(matched.indptr))
+    k1, b = params['k1'], params['b']
+    avg_length = params['avg_length'] or 1.
+    tf = matched.data
+    norms = k1 * (1 - b + b * doc_lengths[rows] / avg_length)
+    weights = params['idf'][matched.indices] * tf * (k1 + 1) / (tf + norms)
+    bm25 = np.bincount(rows, weights=weights, minlength=n_rows).astype(np.float32)
+
+    query_ngrams = _hash_char_ngrams(queries, params['n_features'], params['char_ngram_range'])
+    doc_ngrams = _hash_char_ngrams(documents, params['n_features'], params['char_ngram_range'])
+    dot = _row_sums(query_ngrams.multiply(doc_ngrams))
+    norm_product = np.sqrt(_row_sums(query_ngrams.multiply(query_ngrams)) *
+                           _row_sums(doc_ngrams.multiply(doc_ngrams)))
+
+    features = {
+        'word_overlap': overlap,
+        'word_overlap_ratio': _safe_divide(overlap, n_query_words),
+        'jaccard': _safe_divide(overlap, n_query_words + n_doc_words - overlap),
+        'bm25': bm25,
+        'char_ngram_cosine': _safe_divide(dot, norm_product),
+    }
+    return features
@@ -1,31 +1,65 @@
+import contextlib
 import datetime
 import json
 import os
+import threading
 
-import dateutil.parser
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from . import utils
 
+dateutil_parser = utils.lazy_import('dateutil.parser')
+
+# Marks values missing before an update.
+_MISSING = object()
+
 
 class Meta:
-    """A key-value storage for metainformation."""
+    """
+    A key-value storage for metainformation.
+
+    The storage is a JSON file plus an append-only journal of updates.
+    Entries of collections (datasets, models, etc.) are appended to the journal
+    on save, other changes and large journals cause an atomic rewrite of the file.
+    Readers replay the journal on load, a partially written last record is ignored.
+    """
 
     VERSION = 1
 
+    # Rewrite the file once the journal has that many records.
+    COMPACT_AFTER = 1000
+
     def __init__(self, filename):
         self._filename = filename
         self._parent_dir = os.path.dirname(self._filename)
 
+        self._lock = threading.RLock()
+        self._pending = []
+        # Previous values of pending updates as (collection, key, value).
+        self._undo = []
+        self._rewrite_required = False
+        self._journal_size = 0
+        # Batch depth and deferred saves of each thread, see batch().
+        self._batch_state = threading.local()
+
         # Read from file or create it if it doesn't exist.
         if os.path.exists(self._filename):
             self._load()
         else:
             self._data = self._get_initial_data()
+            self._rewrite_required = True
 
     @property
     def filename(self):
         return self._filename
 
+    @property
+    def journal_filename(self):
+        return self._filename + '.journal'
+
     @property
     def directory(self):
         return os.path.dirname(self._filename)
@@ -50,7 +84,7 @@ class Meta:
     def _from_json(cls, json_data, *, parent_dir):
         data = {}
         for key in ('created_at', 'updated_at'):
-            data[key] = dateutil.parser.parse(json_data[key])
+            data[key] = dateutil_parser.parse(json_data[key])
         data['version'] = json_data['version']
         return data
 
@@ -67,14 +101,174 @@ class Meta:
     def _load(self):
         with open(self._filename) as src:
             json_data = json.load(src)
+        self._journal_size = self._replay_journal(json_data)
         self._data = self._from_json(json_data, parent_dir=self._parent_dir)
         assert self._data.keys() == json_data.keys()
 
+    def _replay_journal(self, json_data):
+        """Apply journal records to raw JSON data. Returns the number of records."""
+        n_records, torn = self._read_journal(self.journal_filename, json_data)
+        if torn:
+            # A record interrupted by a crash.
+            # Appending after it would corrupt the next record.
+            self._rewrite_required = True
+        return n_records
+
+    @staticmethod
+    def _read_journal(path, json_data):
+        """
+        Apply records of a journal file to raw JSON data.
+
+        Returns:
+            The number of records and whether the journal ends with a partial record.
+        """
+
+        if not os.path.exists(path):
+            return 0, False
+
+        n_records = 0
+
+        with open(path) as src:
+            for line in src:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    return n_records, True
+                collection, key, value = record
+                if collection is None:
+                    json_data[key] = value
+                else:
+                    json_data.setdefault(collection, {})[key] = value
+                n_records += 1
+
+        return n_records, False
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """Serialize journal appends and rewrites between processes sharing the meta."""
+        if fcntl is None:
+            yield
+            return
+        with open(self._filename + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _merge_saved_entries(self, json_data):
+        """Add collection entries saved by other writers since this meta was loaded."""
+        if not os.path.exists(self._filename):
+            return
+        with open(self._filename) as src:
+            saved = json.load(src)
+        self._read_journal(self.journal_filename, saved)
+        for key, entries in saved.items():
+            if isinstance(entries, dict) and isinstance(json_data.get(key), dict):
+                for name, value in entries.items():
+                    json_data[key].setdefault(name, value)
+
+    def _set_attr(self, key, value):
+        """Set a top-level JSON-serializable attribute."""
+        with self._lock:
+            if self._data.get(key, self) != value:
+                self._undo.append((None, key, self._data.get(key, _MISSING)))
+                self._data[key] = value
+                self._pending.append((None, key, value))
+
+    def _set_entry(self, collection, key, entry, json_value):
+        """Set an entry of a collection given the entry and its JSON representation."""
+        with self._lock:
+            entries = self._data.setdefault(collection, {})
+            self._undo.append((collection, key, entries.get(key, _MISSING)))
+            entries[key] = entry
+            self._pending.append((collection, key, json_value))
+
+    def _rollback(self):
+        """Revert updates that weren't saved."""
+        with self._lock:
+            for collection, key, value in reversed(self._undo):
+                target = self._data if collection is None else self._data[collection]
+                if value is _MISSING:
+                    target.pop(key, None)
+                else:
+                    target[key] = value
+            self._pending = []
+            self._undo = []
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Defer saves within the block to a single save at its end.
+
+        Only saves of the current thread are deferred.
+        """
+        state = self._batch_state
+        state.depth = getattr(state, 'depth', 0) + 1
+        try:
+            yield self
+        finally:
+            state.depth -= 1
+            if state.depth == 0 and getattr(state, 'save_requested', False):
+                state.save_requested = False
+                self.save()
+
     def save(self):
-        json_data = self._to_json(self._data)
-        assert self._data.keys() == json_data.keys()
-        with open(self._filename, 'w') as dst:
-            json.dump(json_data, dst, indent=2)
+        with self._lock:
+            if getattr(self._batch_state, 'depth', 0):
+                self._batch_state.save_requested = True
+                return
+
+            if self._rewrite_required or self._journal_size + len(self._pending) > self.COMPACT_AFTER:
+                self.compact()
+                return
+
+            if not self._pending:
+                return
+
+            try:
+                lines = [json.dumps(record) + '\n' for record in self._pending]
+            except (TypeError, ValueError):
+                # Unserializable updates would make every later save fail.
+                self._rollback()
+                raise
+
+            try:
+                with self._file_lock(), open(self.journal_filename, 'a') as dst:
+                    dst.writelines(lines)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            except OSError:
+                # Some records may have been written, rewrite the file on the next save.
+                self._rollback()
+                self._rewrite_required = True
+                raise
+
+            self._journal_size += len(self._pending)
+            self._pending = []
+            self._undo = []
+
+    def compact(self):
+        """
+        Atomically rewrite the file with all data and drop the journal.
+
+        Entries saved meanwhile by other writers are re-read and kept.
+        """
+        with self._lock, self._file_lock():
+            try:
+                json_data = self._to_json(self._data)
+                assert self._data.keys() == json_data.keys()
+            except (TypeError, ValueError):
+                self._rollback()
+                raise
+            self._merge_saved_entries(json_data)
+            utils.atomic_write_json(self._filename, json_data)
+            if os.path.exists(self.journal_filename):
+                os.remove(self.journal_filename)
+            self._journal_size = 0
+            self._pending = []
+            self._undo = []
+            self._rewrite_required = False
 
 
 class DataProcessorMeta(Meta):
@@ -99,7 +293,8 @@ class DataProcessorMeta(Meta):
         return data
 
     def add_dataset(self, name, dataset):
-        self._data['datasets'][name] = DatasetSubMeta.from_dataset(dataset, self._parent_dir)
+        submeta = DatasetSubMeta.from_dataset(dataset, self._parent_dir)
+        self._set_entry('datasets', name, submeta, submeta.to_json())
 
 
 class PreprocessorMeta(DataProcessorMeta):
@@ -112,11 +307,14 @@ class FeaturesMeta(DataProcessorMeta):
 
 class CVMeta(Meta):
 
-    def __init__(self, *args, folds_filename='folds.json', n_runs=3, n_folds=3, **kwargs):
+    # Keys missing in metas saved by earlier versions.
+    OPTIONAL_ATTRS = ('searches', 'predictions')
+
+    def __init__(self, *args, folds_filename='folds.npy', n_runs=3, n_folds=3, **kwargs):
         super().__init__(*args, **kwargs)
-        self._data['folds_filename'] = folds_filename
-        self._data['n_runs'] = n_runs
-        self._data['n_folds'] = n_folds
+        self._set_attr('folds_filename', folds_filename)
+        self._set_attr('n_runs', n_runs)
+        self._set_attr('n_folds', n_folds)
 
     @property
     def folds_filename(self):
@@ -130,10 +328,19 @@ class CVMeta(Meta):
     def n_folds(self):
         return self._data['n_folds']
 
+    @property
+    def searches(self):
+        return self._data.setdefault('searches', {})
+
+    @property
+    def predictions(self):
+        return self._data.setdefault('predictions', {})
+
     @classmethod
     def _get_initial_data(cls):
         data = super()._get_initial_data()
-        # data['runs'] = []
+        data['searches'] = {}
+        data['predictions'] = {}
         return data
 
     @classmethod
@@ -141,7 +348,9 @@ class CVMeta(Meta):
         json_data = super()._to_json(data)
         for attr in ('folds_filename', 'n_runs', 'n_folds'):
             json_data[attr] = data[attr]
-        # json_data['runs'] = {name: d.to_json() for name, d in data['datasets'].items()}
+        for attr in cls.OPTIONAL_ATTRS:
+            if attr in data:
+                json_data[attr] = data[attr]
         return json_data
 
     @classmethod
@@ -149,10 +358,27 @@ class CVMeta(Meta):
         data = super()._from_json(json_data, parent_dir=parent_dir)
         for attr in ('folds_filename', 'n_runs', 'n_folds'):
             data[attr] = json_data[attr]
-        # data['runs'] = {name: DatasetSubMeta.from_json_data(data, parent_dir)
-                            # for name, data in json_data['datasets'].items()}
+        for attr in cls.OPTIONAL_ATTRS:
+            if attr in json_data:
+                data[attr] = json_data[attr]
         return data
 
+    def add_search(self, search_id, trials):
+        """
+        Record results of a hyperparameter search.
+
+        Trials are JSON-serializable dicts with parameters, per-fold scores and timings.
+        """
+        self._set_entry('searches', search_id, trials, trials)
+
+    def add_predictions(self, cv_id, predictions):
+        """
+        Record saved out-of-fold and test predictions of a cross-validation.
+
+        Filenames are relative to the meta directory.
+        """
+        self._set_entry('predictions', cv_id, predictions, predictions)
+
 
 class ModelMeta(Meta):
 
@@ -180,7 +406,8 @@ class ModelMeta(Meta):
         return data
 
     def add_model(self, name, model):
-        self._data['models'][name] = ModelSubMeta.from_model(model, name, self._parent_dir)
+        submeta = ModelSubMeta.from_model(model, name, self._parent_dir)
+        self._set_entry('models', name, submeta, submeta.to_json())
 
 
 class SubmissionMeta(Meta):
@@ -193,10 +420,18 @@ class SubMeta:
 
 class PersistedObjectSubMeta(SubMeta):
 
-    def __init__(self, data, parent_dir):
-        self._data = data
+    def __init__(self, data, parent_dir, *, json_data=None):
+        self._decoded_data = data
+        self._json_data = json_data
         self._parent_dir = parent_dir
 
+    @property
+    def _data(self):
+        # Decoding imports classes, so entries are decoded on first access.
+        if self._decoded_data is None:
+            self._decoded_data = self._from_json(self._json_data)
+        return self._decoded_data
+
     @property
     def created_at(self):
         return self._data['created_at']
@@ -211,8 +446,7 @@ class PersistedObjectSubMeta(SubMeta):
 
     @classmethod
     def from_json_data(cls, json_data, parent_dir):
-        data = cls._from_json(json_data)
-        obj = cls(data, parent_dir)
+        obj = cls(None, parent_dir, json_data=json_data)
         return obj
 
     @classmethod
@@ -228,7 +462,7 @@ class PersistedObjectSubMeta(SubMeta):
     @classmethod
     def _from_json(cls, json_data):
         data = {
-            'created_at': dateutil.parser.parse(json_data['created_at']),
+            'created_at': dateutil_parser.parse(json_data['created_at']),
             'type': utils.import_class_by_path(json_data['type']),
             'filename': json_data['filename'],
             'params': json_data['params'],
@@ -236,7 +470,9 @@ class PersistedObjectSubMeta(SubMeta):
         return data
 
     def to_json(self):
-        return self._to_json(self._data)
+        if self._json_data is None:
+            self._json_data = self._to_json(self._data)
+        return self._json_data
 
     def build_object(self):
         obj_type = self._data['type']
@@ -247,6 +483,26 @@ class PersistedObjectSubMeta(SubMeta):
 
 class DatasetSubMeta(PersistedObjectSubMeta):
 
+    @property
+    def fingerprint(self):
+        # Cache checks read only the fingerprint, don't decode the whole entry for it.
+        if self._decoded_data is None:
+            return self._json_data.get('fingerprint')
+        return self._decoded_data['fingerprint']
+
+    @classmethod
+    def _to_json(cls, data):
+        json_data = super()._to_json(data)
+        json_data['fingerprint'] = data['fingerprint']
+        return json_data
+
+    @classmethod
+    def _from_json(cls, json_data):
+        data = super()._from_json(json_data)
+        # Datasets cached before fingerprinting are always considered stale.
+        data['fingerprint'] = json_data.get('fingerprint')
+        return data
+
     @classmethod
     def from_dataset(cls, dataset, parent_dir):
         data = {
@@ -254,10 +510,16 @@ class DatasetSubMeta(PersistedObjectSubMeta):
             'type': dataset.__class__,
             'filename': os.path.basename(dataset.filename),
             'params': dataset.params,
+            'fingerprint': dataset.fingerprint,
         }
         obj = cls(data, parent_dir)
         return obj
 
+    def build_object(self):
+        obj = super().build_object()
+        obj.fingerprint = self.fingerprint
+        return obj
+
 
 class ModelSubMeta(PersistedObjectSubMeta):
 
@@ -267,7 +529,7 @@ class ModelSubMeta(PersistedObjectSubMeta):
             'created_at': datetime.datetime.now(),
             'type': model.__class__,
             'filename': os.path.join(parent_dir, model_name),
-            'params': {},
+            'params': model.save_params,
         }
         obj = cls(data, parent_dir)
         return obj
@@ -1,7 +1,9 @@
 import math
 
-from sklearn.metrics import mean_squared_error
+from .utils import lazy_import
+
+sklearn_metrics = lazy_import('sklearn.metrics')
 
 
 def rmse(y_true, y_pred):
-    return math.sqrt(mean_squared_error(y_true, y_pred))
+    return math.sqrt(sklearn_metrics.mean_squared_error(y_true, y_pred))
@@ -1,17 +1,45 @@
 import os
 
+from .models.base import FeatureMatrix
+from .utils import lazy_import
+
+np = lazy_import('numpy')
+
 
 class ModelMaker:
 
-    def __init__(self, model_id, model, dataset_name, target_col, metric):
+    def __init__(self, model_id, model, dataset_name, target_col, metric, *, validation_size=None):
+        """
+        Args:
+            validation_size: Fraction of rows held out as a test set for
+                early stopping. All rows are used for training if None.
+        """
         self.model_id = model_id
         self.model = model
         self.dataset_name = dataset_name
         self.target_col = target_col
         self.metric = metric
+        self.validation_size = validation_size
+
+    def __str__(self):
+        return '{} {} -> {}'.format(self.__class__.__name__, self.dataset_name, self.model_id)
+
+    def run(self, dataframe, meta, matrix=None):
+        """
+        Fit the model and save it.
+
+        A FeatureMatrix of the dataframe may be passed to share it with other actions.
+        """
+        if matrix is None:
+            matrix = FeatureMatrix(dataframe, self.target_col)
+
+        if self.validation_size:
+            permutation = np.random.permutation(len(matrix))
+            n_test = int(round(len(matrix) * self.validation_size))
+            test_pos, train_pos = np.sort(permutation[:n_test]), np.sort(permutation[n_test:])
+            self.model.fit_matrix(matrix, train_pos, test_pos)
+        else:
+            self.model.fit_matrix(matrix)
 
-    def run(self, dataframe, meta):
-        """Fit the model and save it."""
-        self.model.fit(self.target_col, dataframe)
         path = os.path.join(meta.directory, self.model_id)
         self.model.save(path)
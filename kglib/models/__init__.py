@@ -1 +1,2 @@
+from .base import FeatureMatrix
 from .xgb import XgbModel
@@ -1,6 +1,11 @@
 import pickle
+import threading
 
-import pandas as pd
+from ..sparse import SparseFrame
+from ..utils import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 
 class Model:
@@ -8,27 +13,96 @@ class Model:
     def __init__(self, **kwargs):
         self.params = kwargs
 
+    def set_n_threads(self, n_threads):
+        """Limit the number of threads used for fitting and prediction."""
+        pass
+
     def fit(self, target_col, train_df, test_df=None):
-        X_train, y_train = train_df.drop(target_col, axis=1).values, train_df[target_col].values
+        X_train, y_train = self._split_target(train_df, target_col)
 
         if test_df is not None:
-            X_test, y_test = test_df.drop(target_col, axis=1).values, test_df[target_col].values
+            X_test, y_test = self._split_target(test_df, target_col)
         else:
             X_test, y_test = None, None
 
         self._do_fit(X_train, y_train, X_test, y_test, **self.params)
 
+    @staticmethod
+    def _split_target(dataframe, target_col):
+        """
+        Split a dataframe into feature matrix and target vector.
+
+        For homogeneous dataframes (e.g. memory-mapped ones) with the target
+        in the first or the last column both parts are views without copying.
+        Features of a SparseFrame are returned as a CSR matrix.
+        """
+        if isinstance(dataframe, SparseFrame):
+            X = dataframe.drop(target_col, axis=1).to_csr()
+            y = dataframe[target_col].values
+            return X, y
+
+        values = dataframe.values
+        pos = dataframe.columns.get_loc(target_col)
+        y = dataframe[target_col].values
+        if pos == 0:
+            X = values[:, 1:]
+        elif pos == values.shape[1] - 1:
+            X = values[:, :-1]
+        else:
+            X = np.delete(values, pos, axis=1)
+        return X, y
+
     def _do_fit(self, X_train, y_train, X_test=None, y_test=None, **kwargs):
         raise NotImplementedError
 
+    def fit_matrix(self, matrix, train_pos=None, test_pos=None):
+        """
+        Fit the model on rows of a FeatureMatrix.
+
+        Args:
+            matrix: FeatureMatrix shared between folds and models.
+            train_pos: Positions of training rows. All rows if None.
+            test_pos: Positions of evaluation rows or None.
+        """
+        self._do_fit_matrix(matrix, train_pos, test_pos, **self.params)
+
+    def _do_fit_matrix(self, matrix, train_pos, test_pos, **kwargs):
+        X_train, y_train = matrix.take(train_pos)
+        if test_pos is not None:
+            X_test, y_test = matrix.take(test_pos)
+        else:
+            X_test, y_test = None, None
+        self._do_fit(X_train, y_train, X_test, y_test, **kwargs)
+
+    def predict_matrix(self, matrix, positions=None):
+        """Predict rows of a FeatureMatrix. Returns a numpy array."""
+        return self._do_predict_matrix(matrix, positions)
+
+    def _do_predict_matrix(self, matrix, positions):
+        X, _ = matrix.take(positions)
+        return self._do_predict(X)
+
     def predict(self, X):
-        values = self._do_predict(X.values)
+        if isinstance(X, SparseFrame):
+            values = self._do_predict(X.to_csr())
+        else:
+            values = self._do_predict(X.values)
         series = pd.Series(values, index=X.index)
         return series
 
     def _do_predict(self, X):
         raise NotImplementedError
 
+    @property
+    def fingerprint_params(self):
+        """Parameters affecting predictions of the model, used to identify cached results."""
+        return self.params
+
+    @property
+    def save_params(self):
+        """Keyword arguments for load() to read back a saved model."""
+        return {}
+
     def save(self, path):
         with open(path, 'wb') as dst:
             pickle.dump(self, dst)
@@ -38,3 +112,46 @@ class Model:
         with open(path, 'rb') as src:
             model = pickle.load(src)
         return model
+
+
+class FeatureMatrix:
+    """
+    Feature matrix and label vector of a dataframe.
+
+    Built once per dataset and shared between folds and models,
+    which address rows by position. Models may cache their own
+    representation of the data (e.g. xgboost.DMatrix) with get_cached().
+    """
+
+    def __init__(self, dataframe, target_col):
+        self.X, self.y = Model._split_target(dataframe, target_col)  # pylint: disable=protected-access
+        self.target_col = target_col
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.y)
+
+    def __getstate__(self):
+        # Cached representations are rebuilt by each process.
+        state = self.__dict__.copy()
+        state['_cache'] = {}
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def take(self, positions):
+        """Return (X, y) for rows at positions or for all rows if positions is None."""
+        if positions is None:
+            return self.X, self.y
+        return self.X[positions], self.y[positions]
+
+    def get_cached(self, key, build):
+        """Return a cached object built from the matrix with build(matrix) on first access."""
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = build(self)
+            return self._cache[key]
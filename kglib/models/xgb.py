@@ -1,21 +1,159 @@
-import xgboost as xgb
+import json
+import pickle
+import threading
 
 from .base import Model
+from ..utils import lazy_import
+
+xgb = lazy_import('xgboost')
+
+# Guards lazy booster loading of models shared between threads.
+# Module-level so that models stay picklable.
+_BOOSTER_LOAD_LOCK = threading.Lock()
 
 
 class XgbModel(Model):
 
+    # Booster file extension. xgboost infers UBJSON format from it.
+    BOOSTER_EXTENSION = 'ubj'
+
+    # Parameters not affecting predictions.
+    THREAD_PARAMS = ('nthread', 'n_jobs')
+
+    # Defaults for models pickled by earlier versions.
+    early_stopping_rounds = None
+    best_iteration = None
+    _bst_path = None
+
     def __init__(self, **kwargs):
+        """
+        Keyword arguments are xgboost parameters except for:
+            num_boost_round: Maximum number of boosting rounds.
+            early_stopping_rounds: Stop boosting if the evaluation metric on the test set
+                hasn't improved for this many rounds. Prediction then uses the best iteration.
+                Ignored when fitting without a test set.
+        """
         kwargs.setdefault('silent', 1)
         self.num_boost_round = kwargs.pop('num_boost_round', 10)
+        self.early_stopping_rounds = kwargs.pop('early_stopping_rounds', None)
+        self.best_iteration = None
         self._bst = None
+        # Booster file to read on first use.
+        self._bst_path = None
         super().__init__(**kwargs)
 
+    def set_n_threads(self, n_threads):
+        self.params['nthread'] = n_threads
+
     def _do_fit(self, X_train, y_train, X_test=None, y_test=None, **kwargs):
         dtrain = xgb.DMatrix(X_train, label=y_train)
-        self._bst = xgb.train(kwargs, dtrain, self.num_boost_round)
+        dtest = xgb.DMatrix(X_test, label=y_test) if X_test is not None else None
+        self._train(kwargs, dtrain, dtest)
+
+    def _do_fit_matrix(self, matrix, train_pos, test_pos, **kwargs):
+        dtrain = self._get_dmatrix(matrix, train_pos)
+        dtest = self._get_dmatrix(matrix, test_pos) if test_pos is not None else None
+        self._train(kwargs, dtrain, dtest)
+
+    def _train(self, params, dtrain, dtest=None):
+        self.best_iteration = None
+        self._bst_path = None
+
+        if dtest is None or self.early_stopping_rounds is None:
+            self._bst = xgb.train(params, dtrain, self.num_boost_round)
+            return
+
+        evals = [(dtrain, 'train'), (dtest, 'test')]
+        self._bst = xgb.train(params, dtrain, self.num_boost_round, evals=evals,
+                              early_stopping_rounds=self.early_stopping_rounds,
+                              verbose_eval=False)
+        self.best_iteration = self._bst.best_iteration
+
+    def _do_predict_matrix(self, matrix, positions):
+        data = self._get_dmatrix(matrix, positions)
+        return self._predict(data)
+
+    @staticmethod
+    def _get_dmatrix(matrix, positions):
+        """Slice rows of a DMatrix built once per FeatureMatrix."""
+        dmatrix = matrix.get_cached('xgb.DMatrix',
+                                    lambda m: xgb.DMatrix(m.X, label=m.y))
+        if positions is None:
+            return dmatrix
+        return dmatrix.slice(positions)
 
     def _do_predict(self, X):
         data = xgb.DMatrix(X)
-        y_pred = self._bst.predict(data)
-        return y_pred
+        return self._predict(data)
+
+    def _predict(self, data):
+        """Predict with trees up to the best iteration if early stopping was used."""
+        bst = self._get_booster()
+        if self.best_iteration is None:
+            return bst.predict(data)
+        return bst.predict(data, iteration_range=(0, self.best_iteration + 1))
+
+    def _get_booster(self):
+        if self._bst is None and self._bst_path is not None:
+            with _BOOSTER_LOAD_LOCK:
+                if self._bst is None:
+                    self._bst = xgb.Booster(model_file=self._bst_path)
+        if self._bst is None:
+            raise RuntimeError('{} has not been fit'.format(self.__class__.__name__))
+        return self._bst
+
+    @property
+    def fingerprint_params(self):
+        params = {key: value for key, value in self.params.items()
+                  if key not in self.THREAD_PARAMS}
+        params['num_boost_round'] = self.num_boost_round
+        params['early_stopping_rounds'] = self.early_stopping_rounds
+        return params
+
+    @property
+    def save_params(self):
+        return {'native': True}
+
+    def save(self, path):
+        """
+        Save the booster in xgboost's native format with a JSON sidecar.
+
+        The sidecar at path holds model parameters,
+        the booster is saved next to it. Raises RuntimeError if the model has not been fit.
+        """
+        bst = self._get_booster()
+        sidecar = {
+            'params': self.params,
+            'num_boost_round': self.num_boost_round,
+            'early_stopping_rounds': self.early_stopping_rounds,
+            'best_iteration': self.best_iteration,
+        }
+        with open(path, 'w') as dst:
+            json.dump(sidecar, dst, indent=2)
+        bst.save_model(self._get_booster_path(path))
+
+    @classmethod
+    def load(cls, path, native=False):
+        """
+        Load a saved model.
+
+        The booster of a natively saved model is read on first prediction.
+        Models saved before native serialization are unpickled.
+        """
+        if not native:
+            with open(path, 'rb') as src:
+                return pickle.load(src)
+
+        with open(path) as src:
+            sidecar = json.load(src)
+
+        model = cls(num_boost_round=sidecar['num_boost_round'],
+                    early_stopping_rounds=sidecar['early_stopping_rounds'],
+                    **sidecar['params'])
+        model.best_iteration = sidecar['best_iteration']
+        model._bst_path = cls._get_booster_path(path)  # pylint: disable=protected-access
+        return model
+
+    @classmethod
+    def _get_booster_path(cls, path):
+        return '{}.{}'.format(path, cls.BOOSTER_EXTENSION)
@@ -1,9 +1,15 @@
+import collections
+import concurrent.futures
+import contextlib
+import itertools
 import logging
 import re
 
-import nltk
-
 from .data_processor import DataProcessor
+from .utils import lazy_import
+
+nltk = lazy_import('nltk')
+pd = lazy_import('pandas')
 
 
 LOGGER = logging.getLogger(__name__)
@@ -17,6 +23,11 @@ class Preprocessor(DataProcessor):
 
 class ExtractColumnPreprocessor(Preprocessor):
 
+    row_local = True
+
+    def get_input_columns(self):
+        return [[self.kwargs['col_name']]]
+
     def _do_process(self, dataframes, *, col_name):
         dataframe, = dataframes
         column = dataframe[col_name].to_frame()
@@ -24,54 +35,220 @@ class ExtractColumnPreprocessor(Preprocessor):
 
 
 class FillNanPreprocessor(Preprocessor):
+    """
+    Fill missing values in columns.
+
+    fill_value is either a single value for all columns
+    or a mapping from column name to its fill value.
+    """
+
+    row_local = True
 
     def _do_process(self, dataframes, *, columns, fill_value):
+        if isinstance(fill_value, dict):
+            values = {col: fill_value[col] for col in columns}
+        else:
+            values = {col: fill_value for col in columns}
+
+        # A single pass producing one new dataframe per input.
+        output_dataframes = [input_df.fillna(values) for input_df in dataframes]
+
+        return output_dataframes
+
+
+class StringReplacementPreprocessor(Preprocessor):
+    """
+    Apply regex substitutions to text columns.
+
+    Substitutions are applied in order with vectorized Series.str.replace.
+    With fuse_literals=True consecutive literal substitutions are replaced
+    in a single pass. This is only equivalent to sequential application
+    when replacements don't produce text matched by other patterns.
+    Overlapping literals are matched longest first.
+    """
+
+    row_local = True
+
+    _REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+
+    def _do_process(self, dataframes, *, columns, substitutions, fuse_literals=False):
+        compiled = self._compile(substitutions, fuse_literals)
+
         output_dataframes = []
 
         for input_df in dataframes:
             output_df = input_df.copy()
             for col in columns:
-                output_df[col].fillna(fill_value, inplace=True)
+                data = _as_text(output_df[col])
+                for pattern, repl in compiled:
+                    data = data.str.replace(pattern, repl, regex=True)
+                output_df[col] = data
             output_dataframes.append(output_df)
 
         return output_dataframes
 
+    @classmethod
+    def _compile(cls, substitutions, fuse_literals):
+        """Return a list of (compiled pattern, replacement) pairs."""
+
+        compiled = []
+        literals = []
+
+        def flush_literals():
+            if len(literals) == 1:
+                (literal, repl), = literals
+                compiled.append((re.compile(re.escape(literal)), repl))
+            elif literals:
+                mapping = dict(reversed(literals))  # The first substitution of a literal wins.
+                alternatives = sorted(mapping, key=len, reverse=True)
+                fused = re.compile('|'.join(re.escape(literal) for literal in alternatives))
+                compiled.append((fused, lambda match, m=mapping: m[match.group(0)]))
+            del literals[:]
+
+        for pattern, repl in substitutions:
+            literal = cls._as_literal(pattern) if fuse_literals and '\\' not in repl else None
+            if literal is not None:
+                literals.append((literal, repl))
+            else:
+                flush_literals()
+                compiled.append((re.compile(pattern), repl))
+
+        flush_literals()
+
+        return compiled
+
+    @classmethod
+    def _as_literal(cls, pattern):
+        """Return the text matched by a pattern without regex constructs or None."""
+
+        chars = []
+        escaped = False
+
+        for char in pattern:
+            if escaped:
+                if char.isalnum():
+                    # Character classes, backreferences, etc.
+                    return None
+                chars.append(char)
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char in cls._REGEX_SPECIAL_CHARS:
+                return None
+            else:
+                chars.append(char)
+
+        if escaped or not chars:
+            return None
+
+        return ''.join(chars)
 
-class StringReplacementPreprocessor(Preprocessor):
 
-    def _do_process(self, dataframes, *, columns, substitutions):
+class StemmerPreprocessor(Preprocessor):
+    """
+    Lowercase, tokenize and stem text columns.
+
+    Each distinct token is stemmed once per run of the processor:
+    stems are kept in an LRU cache of at most cache_size tokens shared
+    between columns, dataframes and chunks. With n_jobs > 1 a process pool
+    created once per run tokenizes texts and stems new distinct tokens in chunks.
+    """
+
+    row_local = True
+    runtime_kwargs = ('n_jobs', 'chunk_size', 'cache_size')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._executor = None
+        self._stems = None
+
+    def process(self, dataframes):
+        with self._run_context():
+            return super().process(dataframes)
+
+    def process_chunks(self, chunks):
+        with self._run_context():
+            yield from super().process_chunks(chunks)
+
+    @contextlib.contextmanager
+    def _run_context(self):
+        """Keep the process pool and stems for a single run of the processor."""
+        n_jobs = self.kwargs.get('n_jobs', 1)
+        self._executor = concurrent.futures.ProcessPoolExecutor(n_jobs) if n_jobs > 1 else None
+        self._stems = collections.OrderedDict()
+        try:
+            yield
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+            self._executor = None
+            self._stems = None
+
+    def _do_process(self, dataframes, *, columns, n_jobs=1, chunk_size=10000, cache_size=2 ** 20):
+        stems = self._stems if self._stems is not None else collections.OrderedDict()
         output_dataframes = []
 
         for input_df in dataframes:
             output_df = input_df.copy()
             for col in columns:
-                for pattern, repl in substitutions:
-                    output_df[col] = output_df[col].apply(
-                        lambda x, p=pattern, r=repl: re.sub(p, r, x)
-                    )
+                texts = _as_text(output_df[col]).tolist()
+                stemmed = self._stem_column(texts, stems, chunk_size, cache_size)
+                output_df[col] = pd.Series(stemmed, index=output_df.index)
             output_dataframes.append(output_df)
 
         return output_dataframes
 
+    def _stem_column(self, texts, stems, chunk_size, cache_size):
+        token_lists = self._map_chunks(_tokenize_texts, texts, chunk_size)
 
-class StemmerPreprocessor(Preprocessor):
+        needed = set(itertools.chain.from_iterable(token_lists))
+        unknown = []
+        for token in needed:
+            if token in stems:
+                stems.move_to_end(token)
+            else:
+                unknown.append(token)
+        stems.update(zip(unknown, self._map_chunks(_stem_tokens, unknown, chunk_size)))
 
-    def _do_process(self, dataframes, *, columns):
-        output_dataframes = []
+        # Save & load of '' results to NaN.
+        stemmed = [' '.join([stems[token] for token in tokens]) or ' ' for tokens in token_lists]
 
-        for input_df in dataframes:
-            output_df = input_df.copy()
+        # Evict least recently used stems once the column is done with them.
+        while len(stems) > cache_size:
+            stems.popitem(last=False)
 
-            stemmer = nltk.PorterStemmer()
+        return stemmed
 
-            for col in columns:
-                data = output_df[col]
-                data = data.apply(lambda text: text.lower())
-                data = data.apply(nltk.word_tokenize)
-                data = data.apply(lambda tokens: ' '.join([stemmer.stem(t) for t in tokens]))
-                data.replace('', ' ', inplace=True)  # Save & load of '' results to NaN.
-                output_df[col] = data
+    def _map_chunks(self, func, items, chunk_size, *args):
+        """Apply func(items_chunk, *args) to chunks of items in the pool and concatenate results."""
+        if self._executor is None or len(items) <= chunk_size:
+            return func(items, *args)
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        repeated = [itertools.repeat(arg) for arg in args]
+        results = []
+        for chunk_result in self._executor.map(func, chunks, *repeated):
+            results.extend(chunk_result)
+        return results
 
-            output_dataframes.append(output_df)
 
-        return output_dataframes
+def _as_text(series):
+    """
+    Make a text column usable with .str.
+
+    Chunks or files where a text column is all missing are read as float.
+    """
+    if series.dtype.kind == 'f':
+        return series.astype(object)
+    return series
+
+
+def _tokenize_texts(texts):
+    """Lowercase and tokenize texts."""
+    # Missing texts have no tokens.
+    return [nltk.word_tokenize(text.lower()) if isinstance(text, str) else [] for text in texts]
+
+
+def _stem_tokens(tokens):
+    """Stem distinct tokens, caching is left to the caller."""
+    stemmer = nltk.PorterStemmer()
+    return [stemmer.stem(token) for token in tokens]
@@ -0,0 +1,162 @@
+import contextlib
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+
+def get_peak_rss():
+    """Peak resident set size of the current process in bytes or None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+def get_cpu_time():
+    """
+    CPU time of the process and its finished child processes (e.g. worker pools) in seconds.
+
+    Children are only accounted once they exit.
+    """
+    if resource is None:
+        return time.process_time()
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+class Profiler:
+    """
+    Collects timing and memory statistics of pipeline actions.
+
+    Each profiled action produces a record (a dict) with wall time, CPU time
+    and memory statistics. Code running inside an action adds more statistics
+    to the record of the current thread with add() and timer().
+
+    CPU time is process-wide: it includes concurrently running actions and
+    child processes exited during the action. The OS only reports the peak RSS
+    over the whole life of the process, so records hold that peak
+    (process_peak_rss) and how much the action raised it (peak_rss_increase).
+    Actions not exceeding the earlier peak have no increase whatever they allocate.
+    """
+
+    SUMMARY_COLUMNS = (
+        ('name', 'Action', '{}'),
+        ('wall_time', 'Wall, s', '{:.2f}'),
+        ('cpu_time', 'CPU, s', '{:.2f}'),
+        ('load_time', 'Load, s', '{:.2f}'),
+        ('save_time', 'Save, s', '{:.2f}'),
+        ('process_peak_rss', 'Process peak RSS, MB', '{:.0f}'),
+        ('peak_rss_increase', 'Peak RSS +, MB', '{:.0f}'),
+        ('input_rows', 'Rows in', '{:d}'),
+        ('output_rows', 'Rows out', '{:d}'),
+        ('input_bytes', 'MB in', '{:.1f}'),
+        ('output_bytes', 'MB out', '{:.1f}'),
+        ('cache_hit', 'Cached', '{}'),
+    )
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        """Profile a block of code as a single action."""
+
+        record = {'name': name}
+        self._local.record = record
+
+        start_wall = time.time()
+        start_cpu = get_cpu_time()
+        start_peak_rss = get_peak_rss()
+
+        try:
+            yield record
+        finally:
+            record['wall_time'] = time.time() - start_wall
+            record['cpu_time'] = get_cpu_time() - start_cpu
+            peak_rss = get_peak_rss()
+            record['process_peak_rss'] = peak_rss
+            if peak_rss is not None:
+                record['peak_rss_increase'] = peak_rss - start_peak_rss
+            self._local.record = None
+            with self._lock:
+                self.records.append(record)
+
+    @contextlib.contextmanager
+    def timer(self, key):
+        """Add elapsed time of a block to the current record."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(key, time.time() - start_time)
+
+    @property
+    def current_record(self):
+        """The record of the action running in the current thread or None."""
+        return getattr(self._local, 'record', None)
+
+    @contextlib.contextmanager
+    def attach(self, record):
+        """Add statistics from another thread (e.g. a background save) to a record."""
+        previous = getattr(self._local, 'record', None)
+        self._local.record = record
+        try:
+            yield record
+        finally:
+            self._local.record = previous
+
+    def add(self, key, value):
+        """Add a value to a statistic of the current record."""
+        record = getattr(self._local, 'record', None)
+        if record is not None:
+            record[key] = record.get(key, 0) + value
+
+    def set(self, key, value):
+        """Set a statistic of the current record."""
+        record = getattr(self._local, 'record', None)
+        if record is not None:
+            record[key] = value
+
+    def add_dataframes(self, prefix, dataframes):
+        """Add row counts and sizes of dataframes as <prefix>_rows and <prefix>_bytes."""
+        for dataframe in dataframes:
+            self.add(prefix + '_rows', len(dataframe))
+            self.add(prefix + '_bytes', int(dataframe.memory_usage(index=True).sum()))
+
+    def save(self, path):
+        with open(path, 'w') as dst:
+            json.dump(self.records, dst, indent=2)
+
+    def format_summary(self):
+        """Return a table with a row per action."""
+
+        header = [title for _, title, _ in self.SUMMARY_COLUMNS]
+        rows = [header]
+
+        for record in self.records:
+            row = []
+            for key, _, fmt in self.SUMMARY_COLUMNS:
+                value = record.get(key)
+                if value is None:
+                    row.append('')
+                    continue
+                if key.endswith('_bytes') or key.endswith('_rss') or key == 'peak_rss_increase':
+                    value /= 2 ** 20
+                row.append(fmt.format(value))
+            rows.append(row)
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip()
+                 for row in rows]
+        return '\n'.join(lines)
@@ -1,88 +1,484 @@
+import itertools
 import logging
 import os
+import threading
 
+from .background import Prefetcher, SaveQueue
 from .cross_val import CrossValidator
 from .feature_extractors import FeatureExtractor
 from .model_maker import ModelMaker
+from .models.base import FeatureMatrix
 from .preprocessors import Preprocessor
+from .profiling import Profiler
+from .scheduler import ActionGraph, Scheduler
+from .stacking import Stacker
 from .submission import SubmissionMaker
 
 
 LOGGER = logging.getLogger(__name__)
 
 
+class UnknownTargetError(ValueError):
+    """Requested targets aren't produced by any action."""
+
+
 class Runner:
 
-    def __init__(self, config):
+    def __init__(self, config, *, n_jobs=1, chunk_size=None, force=(), prefetch=1, async_save=False):
+        """
+        Args:
+            n_jobs: Number of independent actions executed concurrently.
+            chunk_size: If set, row-local processors stream their inputs
+                in chunks of this many rows to bound memory usage.
+            force: Names of datasets to recompute even if cached.
+            prefetch: Number of upcoming actions whose available inputs
+                are loaded on a background thread while an action runs. 0 disables prefetching.
+            async_save: Whether processor outputs consumed by later actions are saved
+                on a background thread. Outputs are used from memory meanwhile,
+                so processors must not modify their inputs in place.
+        """
         self.config = config
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.force = set(force)
+        self.prefetch = prefetch
+        self.async_save = async_save
+
+        # Background I/O, only exist during run().
+        self._prefetcher = None
+        self._save_queue = None
+        # Number of actions consuming each key, see ActionGraph.get_consumer_counts().
+        self._consumer_counts = {}
+
+        self.profiler = Profiler()
+
+        # Feature matrices shared by actions using the same dataset and target.
+        self._feature_matrices = {}
+        self._feature_matrices_lock = threading.Lock()
 
-    def run(self):
+        # Guards meta updates from concurrently running actions.
+        self._meta_lock = threading.RLock()
+
+    def run(self, targets=None):
+        """
+        Run the pipeline.
+
+        Args:
+            targets: Names of actions to run along with actions they depend on.
+                All actions are run if None. See get_action_names().
+        """
         self.config.configure_logging()
 
+        actions = self.select_actions(targets)
+
         datasets = self.config.sources.copy()
+        positions = {id(action): i for i, action in enumerate(actions)}
+
+        def run_action(action):
+            if self._prefetcher is not None:
+                i = positions[id(action)]
+                self._prefetch_inputs(actions[i + 1:i + 1 + self.prefetch], datasets)
+            with self.profiler.profile(str(action)):
+                self.run_action(action, datasets)
+
+        def release(key):
+            kind, name = key
+            if kind == 'dataset' and name in datasets:
+                if self._save_queue is not None:
+                    # The file must be complete before the dataframe is dropped.
+                    self._save_queue.wait(name)
+                if self._prefetcher is not None:
+                    self._prefetcher.discard(name)
+                datasets[name].release()
+                self._release_feature_matrices(name)
+
+        graph = ActionGraph(actions, self.get_action_io)
+        scheduler = Scheduler(graph, run_action, release=release, n_jobs=self.n_jobs)
+        self._consumer_counts = graph.get_consumer_counts()
+
+        if self.prefetch:
+            self._prefetcher = Prefetcher()
+        if self.async_save:
+            self._save_queue = SaveQueue()
+
+        try:
+            scheduler.run()
+        finally:
+            try:
+                self._shutdown_background_io()
+            finally:
+                self.profiler.save(os.path.join(self.config.assets_dir, 'profile.json'))
+                LOGGER.info('Profile:\n%s', self.profiler.format_summary())
+
+    def _shutdown_background_io(self):
+        """Stop prefetching and finish pending saves."""
+        prefetcher, self._prefetcher = self._prefetcher, None
+        save_queue, self._save_queue = self._save_queue, None
+        try:
+            if prefetcher is not None:
+                prefetcher.shutdown()
+        finally:
+            if save_queue is not None:
+                save_queue.shutdown()
+
+    def _prefetch_inputs(self, actions, datasets):
+        """Start loading inputs of actions that are already available."""
+        for action in actions:
+            for name, columns in self._get_prefetchable_inputs(action, datasets):
+                LOGGER.debug('Prefetching %s for %s', name, action)
+                self._prefetcher.submit(name, datasets[name], columns)
+
+    def _get_prefetchable_inputs(self, action, datasets):
+        """(name, columns) of inputs an action will load that exist by now."""
+
+        if isinstance(action, (Preprocessor, FeatureExtractor)):
+            if any(name not in datasets for name in action.inputs):
+                return []
+            if self.chunk_size and action.row_local:
+                # Streamed inputs aren't loaded at once.
+                return []
+            input_fingerprints = [datasets[name].fingerprint for name in action.inputs]
+            fingerprint = action.get_fingerprint(input_fingerprints)
+            meta = self._get_data_processor_meta(action)
+            with self._meta_lock:
+                cached = all(self._is_cached(name, fingerprint, meta) for name in action.outputs)
+            if cached:
+                return []
+            inputs = list(zip(action.inputs, action.get_input_columns()))
+        elif isinstance(action, CrossValidator):
+            names = self._get_cv_dataset_names(action)
+            if action.cv_id is not None and all(name in datasets for name in names):
+                input_fingerprints = [datasets[name].fingerprint for name in names]
+                with self._meta_lock:
+                    if action.is_cached(input_fingerprints, self.config.cv_meta):
+                        return []
+            inputs = [(name, None) for name in names]
+        elif isinstance(action, ModelMaker):
+            inputs = [(action.dataset_name, None)]
+        elif isinstance(action, SubmissionMaker):
+            # Batched submissions read their input chunk by chunk.
+            inputs = [] if action.batch_size else [(action.dataset_name, None)]
+        else:
+            inputs = []
+
+        return [(name, columns) for name, columns in inputs if name in datasets]
+
+    def select_actions(self, targets=None):
+        """Return actions producing targets and their upstream actions in declaration order."""
+
+        actions = list(self.config.actions)
+        if targets is None:
+            return actions
+
+        targets = set(targets)
+        indices = [i for i, action in enumerate(actions)
+                   if targets.intersection(self.get_action_names(action))]
+
+        unknown = targets.difference(*[self.get_action_names(actions[i]) for i in indices])
+        if unknown:
+            raise UnknownTargetError('Unknown targets: {}'.format(', '.join(sorted(unknown))))
+
+        graph = ActionGraph(actions, self.get_action_io)
+        return [actions[i] for i in graph.get_upstream(indices)]
+
+    def plan(self, targets=None):
+        """
+        Tell which actions would be run without running them.
+
+        Returns:
+            A list of (action, cached) pairs. Data processors and
+            cross-validations saving predictions can be cached.
+        """
+
+        fingerprints = {name: dataset.fingerprint for name, dataset in self.config.sources.items()}
+        plan = []
+
+        for action in self.select_actions(targets):
+            cached = False
+            if isinstance(action, (Preprocessor, FeatureExtractor)):
+                meta = self._get_data_processor_meta(action)
+                input_fingerprints = [self._get_planned_fingerprint(name, fingerprints)
+                                      for name in action.inputs]
+                fingerprint = action.get_fingerprint(input_fingerprints)
+                cached = all(self._is_cached(name, fingerprint, meta) for name in action.outputs)
+                for name in action.outputs:
+                    fingerprints[name] = fingerprint
+            elif isinstance(action, CrossValidator) and action.cv_id is not None:
+                input_fingerprints = [self._get_planned_fingerprint(name, fingerprints)
+                                      for name in self._get_cv_dataset_names(action)]
+                cached = action.is_cached(input_fingerprints, self.config.cv_meta)
+            plan.append((action, cached))
+
+        return plan
+
+    def _get_planned_fingerprint(self, name, fingerprints):
+        if name in fingerprints:
+            return fingerprints[name]
+        # Datasets produced by actions outside of the plan.
+        for other_meta in (self.config.preprocessed_meta, self.config.features_meta):
+            if name in other_meta.datasets:
+                return other_meta.datasets[name].fingerprint
+        raise KeyError(name)
+
+    def _is_cached(self, name, fingerprint, meta):
+        cached = meta.datasets.get(name)
+        return (cached is not None and cached.fingerprint == fingerprint and
+                name not in self.force)
+
+    def _get_data_processor_meta(self, data_processor):
+        if isinstance(data_processor, Preprocessor):
+            return self.config.preprocessed_meta
+        return self.config.features_meta
+
+    @staticmethod
+    def get_action_names(action):
+        """Names by which an action can be selected as a target."""
+        if isinstance(action, (Preprocessor, FeatureExtractor)):
+            return list(action.outputs)
+        elif isinstance(action, CrossValidator):
+            names = [action.cv_id, getattr(action, 'search_id', None)]
+            return [name for name in names if name is not None]
+        elif isinstance(action, ModelMaker):
+            return [action.model_id]
+        elif isinstance(action, SubmissionMaker):
+            return [action.submission_id]
+        raise RuntimeError('Unknown action "{}"'.format(str(action)))
 
-        for action in self.config.actions:
-            if isinstance(action, Preprocessor):
-                self.run_data_processor(action, self.config.preprocessed_meta, datasets)
-            elif isinstance(action, FeatureExtractor):
-                self.run_data_processor(action, self.config.features_meta, datasets)
-            elif isinstance(action, CrossValidator):
-                self.run_cv(action, self.config.cv_meta, datasets)
-            elif isinstance(action, ModelMaker):
-                self.run_model_maker(action, self.config.model_meta, datasets)
-            elif isinstance(action, SubmissionMaker):
+    def run_action(self, action, datasets):
+        if isinstance(action, Preprocessor):
+            self.run_data_processor(action, self.config.preprocessed_meta, datasets)
+        elif isinstance(action, FeatureExtractor):
+            self.run_data_processor(action, self.config.features_meta, datasets)
+        elif isinstance(action, CrossValidator):
+            self.run_cv(action, self.config.cv_meta, datasets)
+        elif isinstance(action, ModelMaker):
+            self.run_model_maker(action, self.config.model_meta, datasets)
+        elif isinstance(action, SubmissionMaker):
+            with self.profiler.timer('load_time'):
                 model = self._load_model(action.model_id, self.config.model_meta)
-                self.run_submission_maker(action, model, self.config.submission_meta, datasets)
-            else:
-                raise RuntimeError('Unknown action "{}"'.format(str(action)))
+            self.run_submission_maker(action, model, self.config.submission_meta, datasets)
+        else:
+            raise RuntimeError('Unknown action "{}"'.format(str(action)))
+
+    @staticmethod
+    def get_action_io(action):
+        """
+        Keys of objects consumed and produced by an action.
+
+        Keys are ('dataset', name) and ('model', model_id) tuples.
+        """
+        if isinstance(action, (Preprocessor, FeatureExtractor)):
+            inputs = [('dataset', name) for name in action.inputs]
+            outputs = [('dataset', name) for name in action.outputs]
+        elif isinstance(action, CrossValidator):
+            inputs = [('dataset', action.dataset_name)]
+            if isinstance(action, Stacker):
+                inputs.extend(('cv', cv_id) for cv_id in action.base_cv_ids)
+            elif action.test_dataset_name is not None:
+                inputs.append(('dataset', action.test_dataset_name))
+            outputs = [('cv', action.cv_id)] if action.cv_id is not None else []
+        elif isinstance(action, ModelMaker):
+            inputs = [('dataset', action.dataset_name)]
+            outputs = [('model', action.model_id)]
+        elif isinstance(action, SubmissionMaker):
+            inputs = [('dataset', action.dataset_name), ('model', action.model_id)]
+            outputs = []
+        else:
+            raise RuntimeError('Unknown action "{}"'.format(str(action)))
+        return inputs, outputs
 
     def run_data_processor(self, data_processor, meta, datasets):
         """Apply a preprocessor or a feature extractor."""
 
+        input_fingerprints = [datasets[name].fingerprint for name in data_processor.inputs]
+        fingerprint = data_processor.get_fingerprint(input_fingerprints)
+
         cache_available = True
         output_paths = []
 
         for name in data_processor.outputs:
-            if name in meta.datasets:
+            if self._is_cached(name, fingerprint, meta):
                 output_path = meta.datasets[name].filename
             else:
                 output_path = os.path.join(meta.directory, name)
                 cache_available = False
             output_paths.append(output_path)
 
+        self.profiler.set('cache_hit', cache_available)
+
         if cache_available:
             LOGGER.info('Using cache for %s', data_processor)
+        elif self.chunk_size and data_processor.row_local:
+            self._run_data_processor_chunked(data_processor, meta, datasets,
+                                             output_paths, fingerprint)
+            return
         else:
-            input_dataframes = [datasets[name].dataframe for name in data_processor.inputs]
+            input_columns = data_processor.get_input_columns()
+            with self.profiler.timer('load_time'):
+                input_dataframes = [self._load_dataframe(datasets, name, columns)
+                                    for name, columns in zip(data_processor.inputs, input_columns)]
+            self.profiler.add_dataframes('input', input_dataframes)
             output_dataframes = data_processor.process(input_dataframes)
+            self.profiler.add_dataframes('output', output_dataframes)
             params = data_processor.get_dataset_params(output_dataframes)
 
+        if cache_available:
+            for name in data_processor.outputs:
+                datasets[name] = meta.datasets[name].build_object()
+            return
+
+        outputs = []
         for i, name in enumerate(data_processor.outputs):
-            if cache_available:
-                dataset = meta.datasets[name].build_object()
-            else:
-                dataset = data_processor.dataset_type(output_paths[i], **params[i])
+            dataset = data_processor.dataset_type(output_paths[i], **params[i])
+            dataset.fingerprint = fingerprint
+            outputs.append((name, dataset))
+
+        # Outputs nobody consumes are released right away, there is nothing to overlap with.
+        consumed = any(self._consumer_counts.get(('dataset', name)) for name, _ in outputs)
+        if self._save_queue is not None and consumed:
+            self._save_queue.submit([name for name, _ in outputs],
+                                    self._get_background_save(outputs, meta))
+        else:
+            self._save_outputs(outputs, meta)
+
+        for name, dataset in outputs:
+            datasets[name] = dataset
+
+    def _save_outputs(self, outputs, meta):
+        """Save (name, dataset) pairs and commit them to the meta at once."""
+        for _, dataset in outputs:
+            with self.profiler.timer('save_time'):
                 dataset.save()
+        with self._meta_lock, meta.batch():
+            for name, dataset in outputs:
+                meta.add_dataset(name, dataset)
+            meta.save()
+
+    def _get_background_save(self, outputs, meta):
+        """A function saving outputs on another thread with stats added to the current action."""
+        record = self.profiler.current_record
+
+        def save():
+            with self.profiler.attach(record):
+                self._save_outputs(outputs, meta)
+
+        return save
+
+    def _load_dataframe(self, datasets, name, columns=None):
+        """Return a dataframe of a dataset, taking it from the prefetcher if it's there."""
+        dataset = datasets[name]
+        if self._prefetcher is not None:
+            dataframe = self._prefetcher.take(name, dataset, columns)
+            if dataframe is not None:
+                self.profiler.set('prefetched', True)
+                return dataframe
+        return dataset.get_dataframe(columns)
+
+    def _run_data_processor_chunked(self, data_processor, meta, datasets,
+                                    output_paths, fingerprint):
+        """Stream inputs of a row-local processor chunk by chunk into its outputs."""
+
+        input_columns = data_processor.get_input_columns()
+
+        for i, name in enumerate(data_processor.outputs):
+            input_dataset = datasets[data_processor.inputs[i]]
+            chunks = input_dataset.iter_chunks(self.chunk_size, input_columns[i])
+            output_chunks = data_processor.process_chunks(chunks)
+
+            # Dataset parameters are derived from the first chunk.
+            # No chunks at all still make an (empty) output file.
+            first_chunk = next(output_chunks, None)
+            if first_chunk is None:
+                params = {}
+            else:
+                params = data_processor.dataset_type.params_from_dataframe(first_chunk)
+                output_chunks = itertools.chain([first_chunk], output_chunks)
+
+            dataset = data_processor.dataset_type(output_paths[i], **params)
+            dataset.fingerprint = fingerprint
+            # Loading, processing and saving are interleaved and timed together.
+            with self.profiler.timer('save_time'):
+                dataset.save_chunks(output_chunks)
+            with self._meta_lock:
                 meta.add_dataset(name, dataset)
                 meta.save()
 
             datasets[name] = dataset
 
     def run_cv(self, cross_validator, meta, datasets):
-        dataframe = datasets[cross_validator.dataset_name].dataframe
-        cross_validator.run(dataframe, meta)
-        meta.save()
+        input_fingerprints = [datasets[name].fingerprint
+                              for name in self._get_cv_dataset_names(cross_validator)]
+        with self._meta_lock:
+            cached = cross_validator.is_cached(input_fingerprints, meta)
+        self.profiler.set('cache_hit', cached)
+        if cached:
+            LOGGER.info('Using cached predictions for %s', cross_validator)
+            return
+
+        with self.profiler.timer('load_time'):
+            dataframe = self._load_dataframe(datasets, cross_validator.dataset_name)
+            test_dataframe = None
+            if cross_validator.cv_id is not None and cross_validator.test_dataset_name:
+                test_dataframe = self._load_dataframe(datasets, cross_validator.test_dataset_name)
+        self.profiler.add_dataframes('input', [dataframe])
+        matrix = None
+        if cross_validator.uses_feature_matrix:
+            matrix = self._get_feature_matrix(cross_validator.dataset_name,
+                                              cross_validator.target_col, dataframe)
+        cross_validator.run(dataframe, meta, matrix=matrix, test_dataframe=test_dataframe,
+                            input_fingerprints=input_fingerprints)
+        with self._meta_lock:
+            meta.save()
+
+    @staticmethod
+    def _get_cv_dataset_names(cross_validator):
+        """Names of datasets a cross-validation loads."""
+        names = [cross_validator.dataset_name]
+        if cross_validator.cv_id is not None and cross_validator.test_dataset_name:
+            names.append(cross_validator.test_dataset_name)
+        return names
 
     def run_model_maker(self, model_maker, meta, datasets):
-        dataframe = datasets[model_maker.dataset_name].dataframe
-        model_maker.run(dataframe, meta)
-        meta.add_model(model_maker.model_id, model_maker.model)
-        meta.save()
+        with self.profiler.timer('load_time'):
+            dataframe = self._load_dataframe(datasets, model_maker.dataset_name)
+        self.profiler.add_dataframes('input', [dataframe])
+        matrix = self._get_feature_matrix(model_maker.dataset_name,
+                                          model_maker.target_col, dataframe)
+        model_maker.run(dataframe, meta, matrix=matrix)
+        with self._meta_lock:
+            meta.add_model(model_maker.model_id, model_maker.model)
+            meta.save()
 
     def run_submission_maker(self, submission_maker, model, meta, datasets):
-        dataframe = datasets[submission_maker.dataset_name].dataframe
-        submission_maker.run(model, dataframe, 'relevance', meta)
-        meta.save()
+        dataset = datasets[submission_maker.dataset_name]
+        if submission_maker.batch_size:
+            # Read the test set batch by batch instead of loading it at once.
+            batches = dataset.iter_chunks(submission_maker.batch_size)
+            submission_maker.run_batches(model, batches, 'relevance', meta)
+        else:
+            with self.profiler.timer('load_time'):
+                dataframe = self._load_dataframe(datasets, submission_maker.dataset_name)
+            self.profiler.add_dataframes('input', [dataframe])
+            submission_maker.run(model, dataframe, 'relevance', meta)
+        with self._meta_lock:
+            meta.save()
+
+    def _get_feature_matrix(self, dataset_name, target_col, dataframe):
+        """Return a FeatureMatrix built once per dataset and target column."""
+        key = (dataset_name, target_col)
+        with self._feature_matrices_lock:
+            matrix = self._feature_matrices.get(key)
+            if matrix is None:
+                with self.profiler.timer('matrix_time'):
+                    matrix = FeatureMatrix(dataframe, target_col)
+                self._feature_matrices[key] = matrix
+        return matrix
+
+    def _release_feature_matrices(self, dataset_name):
+        with self._feature_matrices_lock:
+            for key in list(self._feature_matrices):
+                if key[0] == dataset_name:
+                    del self._feature_matrices[key]
 
     def _load_model(self, model_id, meta):
         model = meta.models[model_id].build_object()
@@ -0,0 +1,137 @@
+import concurrent.futures
+import logging
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ActionGraph:
+    """
+    Dependency graph of pipeline actions.
+
+    Each action is described by keys it consumes and keys it produces.
+    An action depends on the latest preceding action producing any of its inputs.
+    Inputs without a producer (e.g. sources) impose no dependency.
+    """
+
+    def __init__(self, actions, get_io):
+        """
+        Args:
+            actions: A list of actions in declaration order.
+            get_io: A function returning (inputs, outputs) keys for an action.
+        """
+        self.actions = list(actions)
+        self.inputs = []
+        self.outputs = []
+        self.dependencies = []
+
+        producers = {}
+
+        for i, action in enumerate(self.actions):
+            inputs, outputs = get_io(action)
+            self.inputs.append(list(inputs))
+            self.outputs.append(list(outputs))
+            self.dependencies.append({producers[key] for key in inputs if key in producers})
+            for key in outputs:
+                producers[key] = i
+
+    def get_upstream(self, indices):
+        """Return sorted indices of the given actions and all actions they depend on."""
+        selected = set()
+        stack = list(indices)
+        while stack:
+            i = stack.pop()
+            if i not in selected:
+                selected.add(i)
+                stack.extend(self.dependencies[i])
+        return sorted(selected)
+
+    def get_consumer_counts(self):
+        """Number of actions consuming each key."""
+        counts = {}
+        for i, inputs in enumerate(self.inputs):
+            for key in set(inputs) | set(self.outputs[i]):
+                counts.setdefault(key, 0)
+            for key in set(inputs):
+                counts[key] += 1
+        return counts
+
+
+class Scheduler:
+    """
+    Execute actions of an ActionGraph respecting dependencies.
+
+    Independent actions run concurrently in a thread pool.
+    Once no pending action consumes a key, the release callback is called for it.
+    """
+
+    def __init__(self, graph, run_action, release=None, n_jobs=1):
+        self.graph = graph
+        self.run_action = run_action
+        self.release = release
+        self.n_jobs = n_jobs
+
+        self._remaining_consumers = None
+
+    def run(self):
+        self._remaining_consumers = self.graph.get_consumer_counts()
+
+        if self.n_jobs > 1:
+            self._run_parallel()
+        else:
+            self._run_serial()
+
+    def _run_serial(self):
+        for i, action in enumerate(self.graph.actions):
+            self.run_action(action)
+            self._on_done(i)
+
+    def _run_parallel(self):
+        n_actions = len(self.graph.actions)
+        pending_deps = [set(deps) for deps in self.graph.dependencies]
+        dependants = [[] for _ in range(n_actions)]
+        for i, deps in enumerate(pending_deps):
+            for j in deps:
+                dependants[j].append(i)
+
+        ready = [i for i in range(n_actions) if not pending_deps[i]]
+        running = {}
+
+        with concurrent.futures.ThreadPoolExecutor(self.n_jobs) as executor:
+            while ready or running:
+                # Start actions in declaration order to stay close to serial behaviour.
+                for i in sorted(ready):
+                    future = executor.submit(self.run_action, self.graph.actions[i])
+                    running[future] = i
+                ready = []
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+                for future in done:
+                    i = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception:
+                        for other in running:
+                            other.cancel()
+                        raise
+                    self._on_done(i)
+                    for j in dependants[i]:
+                        pending_deps[j].discard(i)
+                        if not pending_deps[j]:
+                            ready.append(j)
+
+    def _on_done(self, i):
+        keys = set(self.graph.outputs[i])
+        for key in set(self.graph.inputs[i]):
+            self._remaining_consumers[key] -= 1
+            keys.add(key)
+
+        if self.release is None:
+            return
+
+        for key in keys:
+            if self._remaining_consumers[key] == 0:
+                LOGGER.debug('Releasing %s', key)
+                self.release(key)
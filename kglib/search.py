@@ -0,0 +1,138 @@
+import itertools
+import math
+
+from .cross_val import CrossValidator
+from .models.base import FeatureMatrix
+from .utils import lazy_import
+
+np = lazy_import('numpy')
+
+
+class ParamSearch(CrossValidator):
+    """
+    Hyperparameter search scored on cross-validation folds.
+
+    Candidates are the full grid of param_grid or, if n_trials is set,
+    random samples from it. Values of param_grid are lists of options
+    or objects with an rvs() method (e.g. scipy.stats distributions).
+
+    With halving=True all candidates are scored on min_folds folds,
+    the best 1/eta of them are scored on eta times more folds and so on
+    until the remaining ones are scored on all folds (successive halving).
+
+    Folds and the feature matrix are shared with CrossValidator.
+    Results are recorded in CVMeta under search_id.
+    """
+
+    def __init__(self, search_id, model_class, param_grid, dataset_name, target_col, metric, *,
+                 base_params=None, n_trials=None, halving=False, min_folds=1, eta=3,
+                 greater_is_better=False, random_state=None, n_jobs=1, n_threads=None):
+        super().__init__(None, dataset_name, target_col, metric, n_jobs=n_jobs, n_threads=n_threads)
+        self.search_id = search_id
+        self.model_class = model_class
+        self.param_grid = param_grid
+        self.base_params = base_params or {}
+        self.n_trials = n_trials
+        self.halving = halving
+        self.min_folds = min_folds
+        self.eta = eta
+        self.greater_is_better = greater_is_better
+        self.random_state = random_state
+
+    def __str__(self):
+        return '{} {}'.format(self.__class__.__name__, self.search_id)
+
+    def run(self, dataframe, meta, matrix=None, test_dataframe=None, input_fingerprints=None):
+        """Score all candidates and record trials in the meta."""
+
+        if matrix is None:
+            matrix = FeatureMatrix(dataframe, self.target_col)
+
+        folds = self.get_or_create_folds(dataframe, meta)
+        fold_ids = self.get_fold_ids(folds)
+
+        trials = [{'params': params, 'scores': [], 'fit_times': []}
+                  for params in self._get_candidates()]
+        active = list(range(len(trials)))
+
+        rungs = self._get_rungs(len(fold_ids))
+
+        for rung, n_folds in enumerate(rungs):
+            tasks = []
+            owners = []
+            for i in active:
+                n_done = len(trials[i]['scores'])
+                for run_idx, fold_idx in fold_ids[n_done:n_folds]:
+                    tasks.append((self._build_model(trials[i]['params']), run_idx, fold_idx))
+                    owners.append(i)
+
+            for i, (score, elapsed, _, _) in zip(owners, self._score_folds(matrix, folds, tasks)):
+                trials[i]['scores'].append(float(score))
+                trials[i]['fit_times'].append(elapsed)
+
+            if rung < len(rungs) - 1:
+                n_keep = max(1, int(math.ceil(len(active) / self.eta)))
+                active = sorted(active, key=lambda i: self._get_sort_key(trials[i]))[:n_keep]
+
+        for trial in trials:
+            trial['mean_score'] = float(np.mean(trial['scores']))
+            trial['std_score'] = float(np.std(trial['scores']))
+            trial['n_folds'] = len(trial['scores'])
+            trial['fit_time'] = float(np.sum(trial['fit_times']))
+
+        meta.add_search(self.search_id, trials)
+
+        for trial in sorted(trials, key=self._get_sort_key):
+            print('{:.5f} +- {:.5f} ({} folds) {}'.format(
+                trial['mean_score'], trial['std_score'], trial['n_folds'], trial['params']))
+
+    def _get_sort_key(self, trial):
+        """Trials scored on more folds go first, then better ones."""
+        mean_score = np.mean(trial['scores'])
+        if self.greater_is_better:
+            mean_score = -mean_score
+        return -len(trial['scores']), mean_score
+
+    def _get_rungs(self, n_total):
+        """Number of folds each round of successive halving is scored on."""
+        if not self.halving:
+            return [n_total]
+        rungs = []
+        n_folds = self.min_folds
+        while n_folds < n_total:
+            rungs.append(n_folds)
+            n_folds *= self.eta
+        rungs.append(n_total)
+        return rungs
+
+    def _get_candidates(self):
+        names = sorted(self.param_grid)
+
+        if self.n_trials is None:
+            options = [self.param_grid[name] for name in names]
+            return [{name: _to_native(value) for name, value in zip(names, values)}
+                    for values in itertools.product(*options)]
+
+        rng = np.random.RandomState(self.random_state)
+        candidates = []
+        for _ in range(self.n_trials):
+            params = {}
+            for name in names:
+                values = self.param_grid[name]
+                if hasattr(values, 'rvs'):
+                    value = values.rvs(random_state=rng)
+                else:
+                    value = values[rng.randint(len(values))]
+                params[name] = _to_native(value)
+            candidates.append(params)
+        return candidates
+
+    def _build_model(self, params):
+        kwargs = dict(self.base_params)
+        kwargs.update(params)
+        return self.model_class(**kwargs)
+
+
+def _to_native(value):
+    """Convert numpy scalars to native types for serialization."""
+    return value.item() if isinstance(value, np.generic) else value
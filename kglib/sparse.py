@@ -0,0 +1,136 @@
+from .utils import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+scipy_sparse = lazy_import('scipy.sparse')
+
+
+class SparseFrame:
+    """
+    A sparse feature matrix with an index and optional dense columns.
+
+    Stands in for pandas.DataFrame where a frame with one column per
+    feature (e.g. per token of a vocabulary) would be too wide.
+    Dense columns keep targets, ids and numeric features next to
+    the sparse ones. Models take the features as a single CSR matrix
+    with sparse features first and dense ones after them.
+    """
+
+    def __init__(self, matrix, *, index=None, columns=None, dense=None):
+        """
+        Args:
+            matrix: A scipy.sparse matrix or anything convertible to CSR.
+            index: Row labels. A RangeIndex if None.
+            columns: Names of sparse features or None for positional names.
+            dense: A pandas.DataFrame of dense columns aligned with the rows.
+        """
+        self.matrix = scipy_sparse.csr_matrix(matrix)
+        n_rows = self.matrix.shape[0]
+
+        self.index = pd.RangeIndex(n_rows) if index is None else pd.Index(index)
+        if len(self.index) != n_rows:
+            raise ValueError('Index length {} doesn\'t match {} rows'.format(len(self.index), n_rows))
+
+        self.sparse_columns = list(columns) if columns is not None else None
+        if self.sparse_columns is not None and len(self.sparse_columns) != self.matrix.shape[1]:
+            raise ValueError('Got {} column names for {} sparse columns'.format(
+                len(self.sparse_columns), self.matrix.shape[1]))
+
+        if dense is None:
+            dense = pd.DataFrame(index=self.index)
+        elif len(dense) != n_rows:
+            raise ValueError('Dense part has {} rows instead of {}'.format(len(dense), n_rows))
+        elif not dense.index.equals(self.index):
+            dense = dense.set_axis(self.index, axis=0)
+        self.dense = dense
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def shape(self):
+        return len(self), self.matrix.shape[1] + self.dense.shape[1]
+
+    @property
+    def columns(self):
+        """Names of dense columns followed by names of sparse ones."""
+        sparse_columns = self.sparse_columns
+        if sparse_columns is None:
+            sparse_columns = range(self.matrix.shape[1])
+        return pd.Index(list(self.dense.columns) + list(sparse_columns))
+
+    def __contains__(self, col):
+        return col in self.dense.columns
+
+    def __getitem__(self, key):
+        """Select dense columns like a dataframe does."""
+        return self.dense[key]
+
+    def drop(self, labels, axis=1):
+        """Return a frame without the given dense columns."""
+        if axis not in (1, 'columns'):
+            raise ValueError('Only columns can be dropped from a SparseFrame')
+        return self._replace(dense=self.dense.drop(labels, axis=1))
+
+    def take(self, positions):
+        """Return a frame of rows at positions."""
+        positions = np.asarray(positions)
+        return self._replace(matrix=self.matrix[positions], index=self.index[positions],
+                             dense=self.dense.iloc[positions])
+
+    @property
+    def iloc(self):
+        """Positional row selection with slices or position arrays."""
+        return _SparseFrameRowIndexer(self)
+
+    def to_csr(self):
+        """All features as a single CSR matrix. Dense columns are appended after sparse ones."""
+        if self.dense.shape[1] == 0:
+            return self.matrix
+        dense = scipy_sparse.csr_matrix(self.dense.values.astype(self.matrix.dtype))
+        return scipy_sparse.hstack([self.matrix, dense], format='csr')
+
+    def memory_usage(self, index=True):
+        """Memory used by sparse and dense parts in bytes."""
+        matrix = self.matrix
+        usage = {'sparse': matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes}
+        dense_usage = self.dense.memory_usage(index=index)
+        if index:
+            usage['Index'] = dense_usage.pop('Index')
+        usage.update(dense_usage.items())
+        return pd.Series(usage)
+
+    def _replace(self, **kwargs):
+        params = {
+            'matrix': self.matrix,
+            'index': self.index,
+            'columns': self.sparse_columns,
+            'dense': self.dense,
+        }
+        params.update(kwargs)
+        return self.__class__(params.pop('matrix'), **params)
+
+    @classmethod
+    def concat_rows(cls, frames):
+        """Stack frames with the same columns vertically."""
+        frames = list(frames)
+        matrix = scipy_sparse.vstack([frame.matrix for frame in frames], format='csr')
+        index = frames[0].index.append([frame.index for frame in frames[1:]])
+        dense = pd.concat([frame.dense for frame in frames])
+        return cls(matrix, index=index, columns=frames[0].sparse_columns, dense=dense)
+
+    def __repr__(self):
+        return '<{} {}x{} ({} sparse, {} dense), {} stored values>'.format(
+            self.__class__.__name__, self.shape[0], self.shape[1],
+            self.matrix.shape[1], self.dense.shape[1], self.matrix.nnz)
+
+
+class _SparseFrameRowIndexer:
+
+    def __init__(self, frame):
+        self._frame = frame
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            key = np.arange(len(self._frame))[key]
+        return self._frame.take(key)
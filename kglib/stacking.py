@@ -0,0 +1,90 @@
+import os
+
+from .cross_val import CrossValidator, get_folds_digest
+from .utils import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+
+class Stacker(CrossValidator):
+    """
+    Cross-validate a meta-model on cached predictions of base models.
+
+    Base models are cross-validations run with a cv_id. Their out-of-fold
+    predictions averaged over runs are the features of the meta-model,
+    so trying another meta-model doesn't refit base models.
+    If all base models saved test predictions, their averages over fold models
+    are predicted by each fold's meta-model.
+
+    Predictions of the stacker are saved under its own cv_id,
+    so stackers can be stacked in turn.
+    """
+
+    # Features are built from cached predictions instead of the dataset.
+    uses_feature_matrix = False
+
+    def __init__(self, cv_id, base_cv_ids, model, dataset_name, target_col, metric, **kwargs):
+        super().__init__(model, dataset_name, target_col, metric, cv_id=cv_id, **kwargs)
+        self.base_cv_ids = list(base_cv_ids)
+
+    def __str__(self):
+        return '{} {} -> {}'.format(self.__class__.__name__, ','.join(self.base_cv_ids), self.cv_id)
+
+    def get_fingerprint(self, input_fingerprints, meta):
+        # Predictions of base models stand for the model's input.
+        base_fingerprints = [meta.predictions.get(cv_id, {}).get('fingerprint')
+                             for cv_id in self.base_cv_ids]
+        if None in base_fingerprints:
+            return None
+        return super().get_fingerprint(list(input_fingerprints) + base_fingerprints, meta)
+
+    def run(self, dataframe, meta, matrix=None, test_dataframe=None, input_fingerprints=None):
+        stacked_df = self.get_stacked_dataframe(dataframe, meta)
+        stacked_test_df = self.get_stacked_test_dataframe(meta)
+        super().run(stacked_df, meta, test_dataframe=stacked_test_df,
+                    input_fingerprints=input_fingerprints)
+
+    def get_stacked_dataframe(self, dataframe, meta):
+        """Out-of-fold predictions of base models and the target."""
+
+        columns = {}
+        folds_digest = get_folds_digest(self.get_or_create_folds(dataframe, meta))
+
+        for cv_id in self.base_cv_ids:
+            predictions = self._get_base_predictions(cv_id, meta, folds_digest)
+            oof = np.load(os.path.join(meta.directory, predictions['oof_filename']), mmap_mode='r')
+            if oof.shape[1] != len(dataframe):
+                raise ValueError('Predictions of "{}" were made for another dataset'.format(cv_id))
+            columns[cv_id] = np.nanmean(oof, axis=0)
+
+        stacked_df = pd.DataFrame(columns, index=dataframe.index, columns=self.base_cv_ids)
+        stacked_df[self.target_col] = dataframe[self.target_col].values
+        return stacked_df
+
+    def get_stacked_test_dataframe(self, meta):
+        """Test predictions of base models averaged over folds or None if any is missing."""
+
+        columns = {}
+
+        for cv_id in self.base_cv_ids:
+            predictions = self._get_base_predictions(cv_id, meta)
+            if predictions['test_filename'] is None:
+                return None
+            test = np.load(os.path.join(meta.directory, predictions['test_filename']),
+                           mmap_mode='r')
+            columns[cv_id] = test.mean(axis=0)
+
+        return pd.DataFrame(columns, columns=self.base_cv_ids)
+
+    def _get_base_predictions(self, cv_id, meta, folds_digest=None):
+        try:
+            predictions = meta.predictions[cv_id]
+        except KeyError:
+            raise ValueError('No saved predictions for "{}"'.format(cv_id))
+
+        # Records made before folds digests can't be checked.
+        if folds_digest is not None and predictions.get('folds_digest') != folds_digest:
+            raise ValueError('Predictions of "{}" were made on other folds'.format(cv_id))
+
+        return predictions
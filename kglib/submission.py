@@ -1,18 +1,76 @@
+import collections
+import concurrent.futures
 import os
 
-import pandas as pd
+from .utils import lazy_import
+
+pd = lazy_import('pandas')
 
 
 class SubmissionMaker:
 
-    def __init__(self, submission_id, model_id, dataset_name):
+    def __init__(self, submission_id, model_id, dataset_name, *, batch_size=None, n_jobs=1):
+        """
+        Args:
+            batch_size: If set, predict and write this many rows at a time.
+            n_jobs: Number of batches predicted concurrently.
+        """
         self.submission_id = submission_id
         self.model_id = model_id
         self.dataset_name = dataset_name
+        self.batch_size = batch_size
+        self.n_jobs = n_jobs
+
+    def __str__(self):
+        return '{} {},{} -> {}'.format(self.__class__.__name__, self.model_id,
+                                       self.dataset_name, self.submission_id)
 
     def run(self, model, dataframe, result_col_name, meta):
         """Prepare a submission and save it to a CSV file."""
-        predictions = model.predict(dataframe)
-        predictions = pd.DataFrame(predictions, columns=[result_col_name])
+        if self.batch_size:
+            batches = (dataframe.iloc[start:start + self.batch_size]
+                       for start in range(0, len(dataframe), self.batch_size))
+        else:
+            batches = [dataframe]
+        self.run_batches(model, batches, result_col_name, meta)
+
+    def run_batches(self, model, batches, result_col_name, meta):
+        """
+        Prepare a submission from an iterable of dataframe batches.
+
+        Predictions are appended to the CSV file batch by batch in order.
+        """
         path = os.path.join(meta.directory, self.submission_id)
-        predictions.to_csv(path)
+
+        empty = True
+        for predictions in self._predict_batches(model, batches):
+            predictions = pd.DataFrame(predictions, columns=[result_col_name])
+            if empty:
+                predictions.to_csv(path)
+            else:
+                predictions.to_csv(path, mode='a', header=False)
+            empty = False
+
+        if empty:
+            # A header-only file for an empty dataset.
+            pd.DataFrame(columns=[result_col_name]).to_csv(path)
+
+    def _predict_batches(self, model, batches):
+        """Yield predictions for batches in order."""
+
+        if self.n_jobs <= 1:
+            for batch in batches:
+                yield model.predict(batch)
+            return
+
+        # Bound the number of batches held in memory.
+        max_pending = 2 * self.n_jobs
+
+        with concurrent.futures.ThreadPoolExecutor(self.n_jobs) as executor:
+            pending = collections.deque()
+            for batch in batches:
+                pending.append(executor.submit(model.predict, batch))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
@@ -1,5 +1,7 @@
 import importlib
+import json
 import os
+import tempfile
 
 
 def import_class_by_path(path):
@@ -22,3 +24,50 @@ def ensure_extension(filename, extension):
     if not ext:
         filename = '{}.{}'.format(filename, extension)
     return filename
+
+
+def atomic_write_json(path, data):
+    """Write JSON to a file so that readers see either old or new contents."""
+    directory = os.path.dirname(path) or '.'
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as dst:
+        json.dump(data, dst, indent=2)
+        dst.flush()
+        os.fsync(dst.fileno())
+    # Temporary files are private, give the file the mode of a regularly created one.
+    os.chmod(dst.name, 0o666 & ~get_umask())
+    os.replace(dst.name, path)
+
+
+def get_umask():
+    """The file mode creation mask of the process."""
+    global _UMASK  # pylint: disable=global-statement
+    if _UMASK is None:
+        # The mask can only be read by setting it, do it once.
+        _UMASK = os.umask(0o022)
+        os.umask(_UMASK)
+    return _UMASK
+
+
+_UMASK = None
+
+
+class LazyModule:
+    """A proxy importing a module on first attribute access."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            # The import machinery serializes concurrent imports.
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self._name)
+
+
+def lazy_import(name):
+    """Return a proxy of a module which is imported on first use."""
+    return LazyModule(name)
@@ -4,5 +4,10 @@ from setuptools import setup
 setup(
     name='kglib',
     version='0.1',
-    packages=['kglib'],
+    packages=['kglib', 'kglib.models'],
+    entry_points={
+        'console_scripts': [
+            'kglib = kglib.cli:main',
+        ],
+    },
 )